@@ -1,6 +1,12 @@
 # encoding: utf-8
 
+import gzip
+import json
+import time
+import heapq
+import bisect
 import hashlib
+import itertools
 import collections
 
 import market
@@ -8,10 +14,24 @@ import market
 
 IMG_BASE_URL = 'http://market.bot.rpg-club.com/img/%(item_id)s.png'
 
+DEMAND = 1
+OFFER = 2
+
+# ETags must not match between server restarts, versions are counted from zero again
+_BOOT_ID = '%x' % int(time.time())
+
+IGNORE_SNAPSHOTS = 64  # snapshots filtered by distinct ignore lists kept per book version
+GZIP_LEVEL = 6
+
+# columns of compact dupes list, `*_STRINGS` are indexes in its string table
+COMPACT_COLUMNS = ('id', 'equity', 'buy_count', 'required_aden', 'item_id', 'mod', 'seller_date', 'buyer_date')
+COMPACT_STRINGS = ('server', 'item_name', 'seller_name', 'seller_city', 'buyer_name', 'buyer_city')
+
 
 class Dupe:
-   def __init__(self, demand, offer):
-      buy_count = min(demand.count, offer.count)
+   def __init__(self, demand, offer, buy_count=None):
+      if buy_count is None:
+         buy_count = min(demand.count, offer.count)
       equity = buy_count * (demand.cost - offer.cost)
 
       self.demand = demand
@@ -20,14 +40,32 @@ class Dupe:
       self.equity = equity
       self.buy_count = buy_count
 
+      self._dict = None
+
+   @property
+   def id(self):
+      h = hashlib.md5()
+      h.update(get_trade_hash(self.demand).encode())
+      h.update(get_trade_hash(self.offer).encode())
+      return h.hexdigest()
+
    def to_dict(self):
+      # same dupe is shared by the snapshot and all its ignore-filtered variants
+      if self._dict is None:
+         self._dict = self._to_dict()
+      return self._dict
+
+   def _to_dict(self):
       return {
+         'id': self.id,
+         'server': self.offer.server,
          'item_name': self.offer.item_name,
          'equity': self.equity,
          'buy_count': self.buy_count,
          'required_aden': self.buy_count * self.offer.cost,
          'img_url': None if self.offer.item_id is None else IMG_BASE_URL % {'item_id': self.offer.item_id},
          'item_id': self.offer.item_id,
+         'mod': self.offer.book_key[2],
          'seller': {
             'name': self.offer.owner_name,
             'city': self.offer.city,
@@ -57,59 +95,585 @@ class Dupe:
 
 
 def get_trade_hash(trade):
+   return trade.fingerprint
+
+
+def get_ignore_hash(ignore_trades):
    h = hashlib.md5()
-   h.update(str(int(trade.date.timestamp())).encode())
-   h.update(trade.city.encode())
-   h.update(trade.owner_name.encode())
-   h.update(trade.item_name.encode())
-   h.update(str(trade.item_id).encode())
+   for trade_hash in sorted(set(ignore_trades)):
+      h.update(trade_hash.encode())
    return h.hexdigest()
 
 
-def get_dupes(ignore_trades=None):
-   if ignore_trades is None:
-      ignore_trades = []
+def encode_compact(items):
+   # Columnar form of dupe dicts: one list per field, repeated names and cities are indexes
+   # in `strings`, image url is built on client from `img_url` template and item id
+   strings = []
+   codes = {}
 
-   dupes = []
-   ignored = []
+   def code(value):
+      idx = codes.get(value)
+      if idx is None:
+         idx = codes[value] = len(strings)
+         strings.append(value)
+      return idx
 
-   trades = market.get_trades()
+   columns = {name: [] for name in COMPACT_COLUMNS + COMPACT_STRINGS}
+   for d in items:
+      seller = d['seller']
+      buyer = d['buyer']
+      row = (
+         (d['id'], d['equity'], d['buy_count'], d['required_aden'], d['item_id'], d['mod'], seller['date'], buyer['date']),
+         (d['server'], d['item_name'], seller['name'], seller['city'], buyer['name'], buyer['city']),
+      )
+      for name, value in zip(COMPACT_COLUMNS, row[0]):
+         columns[name].append(value)
+      for name, value in zip(COMPACT_STRINGS, row[1]):
+         columns[name].append(code(value))
 
-   offers = collections.defaultdict(list)
-   for o in trades.offers:
-      offer_hash = get_trade_hash(o)
-      if offer_hash in ignore_trades:
-         ignored.append(offer_hash)
-         continue
+   return {
+      'count': len(items),
+      'img_url': IMG_BASE_URL.replace('%(item_id)s', '{item_id}'),
+      'strings': strings,
+      'columns': columns,
+   }
 
-      offers[o.item_name].append(o)
-      offers[o.item_name].sort(key=lambda x: (x.cost, -x.count))  # cost asc, count desc
 
-   for demand in sorted(trades.demands, key=lambda x: (x.cost, x.count), reverse=True):  # cost desc, count desc
-      demand_hash = get_trade_hash(demand)
-      if demand_hash in ignore_trades:
-         ignored.append(demand_hash)
-         continue
+def _dupe_order(d):
+   # best first: equity desc, then id, so order is total and stable between versions
+   return (-d['equity'], d['id'])
 
-      item_offers = offers.get(demand.item_name)
 
-      if not item_offers:
-         continue
+class DupeQuery:
+   # Filters and page of dupes list, see Snapshot.query
+   def __init__(self, min_equity=None, max_required_aden=None, item=None, city=None, limit=None, cursor=None):
+      self.min_equity = min_equity
+      self.max_required_aden = max_required_aden
+      self.item = item
+      self.city = city
+      self.limit = limit
+      self.cursor = cursor
+
+      self._item_id = int(item) if item is not None and item.isdigit() else None
+      self._item_name = item.lower() if item is not None else None
+      self._city = city.lower() if city is not None else None
+
+      self._after = None
+      if cursor is not None:
+         equity, _, dupe_id = cursor.partition(':')
+         if not dupe_id:
+            raise ValueError('Invalid cursor: %r' % cursor)
+         self._after = (-int(equity), dupe_id)
+
+   def key(self):
+      return (self.min_equity, self.max_required_aden, self.item, self.city, self.limit, self.cursor)
 
-      dupe_offers = [o for o in item_offers if o.count and o.cost < demand.cost]
-      if not dupe_offers:
+   def __repr__(self):
+      return 'DupeQuery%r' % (self.key(),)
+
+   def __hash__(self):
+      return hash(self.key())
+
+   def __eq__(self, other):
+      return isinstance(other, DupeQuery) and self.key() == other.key()
+
+   def match(self, d):
+      if self.min_equity is not None and d['equity'] < self.min_equity:
+         return False
+      if self.max_required_aden is not None and d['required_aden'] > self.max_required_aden:
+         return False
+      if self._item_id is not None:
+         if d['item_id'] != self._item_id:
+            return False
+      elif self._item_name is not None and self._item_name not in d['item_name'].lower():
+         return False
+      if self._city is not None and not (
+         d['seller']['city'].lower().startswith(self._city) or d['buyer']['city'].lower().startswith(self._city)
+      ):
+         return False
+      return True
+
+   @staticmethod
+   def make_cursor(d):
+      return '%d:%s' % (d['equity'], d['id'])
+
+
+def plan_purchases(items, budget):
+   # Fractional knapsack over units of dupes: units with the best equity per spent aden go first,
+   # the last affordable dupe is bought partially and the rest of budget is filled by cheaper ones.
+   # Result is short of the optimum by less than equity of one unit, and costs a single sort.
+   candidates = sorted(items, key=lambda d: (-d['equity'] / d['required_aden'], d['id']))
+
+   left = budget
+   buys = []
+   total_equity = 0
+   for d in candidates:
+      unit_cost = d['required_aden'] // d['buy_count']
+      if unit_cost > left:
          continue
 
-      while demand.count:
-         offer = next((o for o in dupe_offers if o.count and not o.bulk), None)
-         if offer is None:
-            break
+      count = min(d['buy_count'], left // unit_cost)
+      equity = count * (d['equity'] // d['buy_count'])
+      buys.append(dict(d, buy_count=count, required_aden=count * unit_cost, equity=equity))
+      left -= count * unit_cost
+      total_equity += equity
+
+   return {
+      'budget': budget,
+      'spent': budget - left,
+      'equity': total_equity,
+      'buys': buys,
+   }
+
+
+def city_name(city):
+   # 'Giran x:83400 y:147900' -> 'giran'
+   return city.split(None, 1)[0].lower() if city else ''
+
+
+class AlertIndex:
+   # Alert subscriptions (see market.get_alerts) by every (server, item id, city name) they
+   # watch, None part of a key matches any. Alerts of a key are ordered by min equity, so a
+   # dupe visits only alerts of its own 12 keys which it pays enough for, not all of them.
+   def __init__(self, alerts=()):
+      self.alerts = {}  # id -> alert
+      self._keys = {}  # key -> sorted [(min equity, alert id), ...]
+      for alert in alerts:
+         self.add(alert)
+
+   def __len__(self):
+      return len(self.alerts)
+
+   @staticmethod
+   def _alert_keys(alert):
+      return itertools.product([alert['server']], alert['items'] or [None], alert['cities'] or [None])
+
+   @staticmethod
+   def _entry(alert):
+      return (alert['min_equity'] or 0, alert['id'])
+
+   def add(self, alert):
+      self.remove(alert['id'])
+      self.alerts[alert['id']] = alert
+      entry = self._entry(alert)
+      for key in self._alert_keys(alert):
+         bisect.insort(self._keys.setdefault(key, []), entry)
+
+   def remove(self, alert_id):
+      alert = self.alerts.pop(alert_id, None)
+      if alert is None:
+         return
+
+      entry = self._entry(alert)
+      for key in self._alert_keys(alert):
+         entries = self._keys[key]
+         del entries[bisect.bisect_left(entries, entry)]
+         if not entries:
+            del self._keys[key]
+
+   def match(self, items):
+      # dupe dicts -> {alert id: [dupes]}
+      matched = collections.defaultdict(list)
+      for d in items:
+         found = set()
+         cities = {None, city_name(d['seller']['city']), city_name(d['buyer']['city'])}
+         for key in itertools.product({None, d['server']}, {None, d['item_id']}, cities):
+            entries = self._keys.get(key)
+            if entries is None:
+               continue
+
+            end = bisect.bisect_right(entries, (d['equity'], float('inf')))
+            for _, alert_id in itertools.islice(entries, end):
+               if alert_id in found:
+                  continue
+               max_required_aden = self.alerts[alert_id]['max_required_aden']
+               if max_required_aden is not None and d['required_aden'] > max_required_aden:
+                  continue
+               found.add(alert_id)
+               matched[alert_id].append(d)
+
+      return matched
+
+
+class Snapshot:
+   def __init__(self, version, dupes, ignored=None):
+      self.version = version
+      self.dupes = dupes
+      self.ignored = ignored or []  # hashes from ignore list, which were found in the book
+      self.items = [d.to_dict() for d in dupes]
+
+      self._body = None
+      self._server_items = {}
+      self._server_bodies = {}
+      self._result_bodies = {}
+      self._compact_bodies = {}
+      self._compressed = {}
+      self._indexes = {}
+
+   def get_items(self, server=None):
+      if server is None:
+         return self.items
+
+      items = self._server_items.get(server)
+      if items is None:
+         items = self._server_items[server] = [d for d in self.items if d['server'] == server]
+      return items
+
+   def get_index(self, server=None):
+      # items ordered best first and their sort keys for bisect, built once per version
+      index = self._indexes.get(server)
+      if index is None:
+         items = sorted(self.get_items(server), key=_dupe_order)
+         index = self._indexes[server] = ([_dupe_order(d) for d in items], items)
+      return index
+
+   def query(self, query, server=None):
+      # Returns (items, cursor of the next page or None)
+      limit = query.limit
+      if limit is not None and query.cursor is None and server not in self._indexes:
+         # best N of one-off filter: heap over matching dupes, no full sort
+         found = heapq.nsmallest(limit + 1, filter(query.match, self.get_items(server)), key=_dupe_order)
+      else:
+         keys, items = self.get_index(server)
+         start = 0 if query._after is None else bisect.bisect_right(keys, query._after)
+         found = []
+         for d in itertools.islice(items, start, None):
+            if query.min_equity is not None and d['equity'] < query.min_equity:
+               break  # index is ordered by equity, nothing more to match
+            if query.match(d):
+               found.append(d)
+               if limit is not None and len(found) > limit:
+                  break
+
+      if limit is not None and len(found) > limit:
+         return found[:limit], DupeQuery.make_cursor(found[limit - 1])
+      return found, None
+
+   def get_compact_body(self, server=None, with_ignored=False):
+      key = (server, with_ignored)
+      body = self._compact_bodies.get(key)
+      if body is None:
+         result = {'dupes': encode_compact(self.get_items(server))}
+         if with_ignored:
+            result['ignored'] = self.ignored
+         body = self._compact_bodies[key] = json.dumps(result, separators=(',', ':')).encode()
+      return body
+
+   def get_compressed(self, key, body):
+      # gzip of a cached body, compressed once per snapshot
+      compressed = self._compressed.get(key)
+      if compressed is None:
+         compressed = self._compressed[key] = gzip.compress(body, GZIP_LEVEL)
+      return compressed
+
+   def get_query_body(self, query, server=None, with_ignored=False, compact=False):
+      items, cursor = self.query(query, server)
+      result = {'dupes': encode_compact(items) if compact else items, 'next': cursor}
+      if with_ignored:
+         result['ignored'] = self.ignored
+      return json.dumps(result).encode()
+
+   def get_body(self, server=None):
+      if server is None:
+         if self._body is None:
+            self._body = json.dumps(self.items).encode()
+         return self._body
+
+      body = self._server_bodies.get(server)
+      if body is None:
+         body = self._server_bodies[server] = json.dumps(self.get_items(server)).encode()
+      return body
+
+   def get_result_body(self, server=None):
+      # body of answer to POST with ignore list
+      body = self._result_bodies.get(server)
+      if body is None:
+         body = self._result_bodies[server] = json.dumps({
+            'dupes': self.get_items(server),
+            'ignored': self.ignored,
+         }).encode()
+      return body
+
+   def get_plan_body(self, budget, server=None, city=None):
+      items = self.get_items(server)
+      if city is not None:
+         items = filter(DupeQuery(city=city).match, items)
+      return json.dumps(plan_purchases(items, budget)).encode()
+
+   def get_etag(self, ignore_trades=None, server=None, query=None):
+      parts = [_BOOT_ID, str(self.version)]
+      if server is not None:
+         parts.append(server)
+      if ignore_trades:
+         parts.append(get_ignore_hash(ignore_trades))
+      if query is not None:
+         # any filter or request params with stable repr
+         parts.append(hashlib.md5(repr(query).encode()).hexdigest())
+      return '"%s"' % '-'.join(parts)
+
+   def diff(self, prev=None, server=None):
+      prev_items = {} if prev is None else {d['id']: d for d in prev.get_items(server)}
+      new = []
+      changed = []
+
+      for d in self.get_items(server):
+         prev_d = prev_items.pop(d['id'], None)
+         if prev_d is None:
+            new.append(d)
+         elif prev_d != d:
+            changed.append(d)
+
+      return {
+         'version': self.version,
+         'new': new,
+         'changed': changed,
+         'removed': list(prev_items),
+      }
+
+
+class BookSide:
+   def __init__(self, key):
+      self._key = key
+      self._keys = []
+      self.trades = []
+
+   def __len__(self):
+      return len(self.trades)
+
+   def add(self, trade, seq):
+      key = self._key(trade, seq)
+      idx = bisect.bisect(self._keys, key)
+      self._keys.insert(idx, key)
+      self.trades.insert(idx, trade)
+      return key
+
+   def remove(self, key):
+      idx = bisect.bisect_left(self._keys, key)
+      del self._keys[idx]
+      del self.trades[idx]
+
+
+class ItemBook:
+   def __init__(self):
+      self.bids = BookSide(lambda t, seq: (-t.cost, -t.count, seq))  # cost desc, count desc
+      self.asks = BookSide(lambda t, seq: (t.cost, -t.count, seq))  # cost asc, count desc
+
+   def __len__(self):
+      return len(self.bids) + len(self.asks)
+
+   def side(self, type_):
+      return self.bids if type_ == DEMAND else self.asks
+
+   def is_crossed(self):
+      return bool(self.bids and self.asks) and self.bids.trades[0].cost > self.asks.trades[0].cost
+
+   def match(self, skip=None):
+      dupes = []
+      if not self.is_crossed():
+         return dupes
+
+      asks = self.asks.trades
+      ask_idx = 0
+      ask_left = 0
+
+      for bid in self.bids.trades:
+         if skip and bid in skip:
+            continue
+
+         bid_left = bid.count
+         while bid_left:
+            while not ask_left and ask_idx < len(asks):
+               ask = asks[ask_idx]
+               ask_idx += 1
+               if not ask.bulk and not (skip and ask in skip):
+                  ask_left = ask.count
+
+            if not ask_left or ask.cost >= bid.cost:
+               # asks are sorted, so no one of the next (cheaper) bids can be matched too
+               return dupes
+
+            buy_count = min(bid_left, ask_left)
+            dupes.append(Dupe(bid, ask, buy_count))
+            bid_left -= buy_count
+            ask_left -= buy_count
+
+      return dupes
+
+
+class MarketBook:
+   def __init__(self):
+      self.items = {}
+      self.dupes = {}
+      self.loaded = False
+      self.version = 0
+
+      self._snapshot = None
+      self._ignore_snapshots = collections.OrderedDict()  # frozenset of ignored hashes -> Snapshot
+
+      # server -> type -> trade -> (trade, item key, book key, trade hash)
+      self._entries = {}
+      self._hashes = {}  # trade hash -> [trade, ...]
+      self._seq = itertools.count()
+
+   def _server_entries(self, server):
+      entries = self._entries.get(server)
+      if entries is None:
+         entries = self._entries[server] = {DEMAND: {}, OFFER: {}}
+      return entries
+
+   def sync(self, trades):
+      # Scrape of one server replaces only this server trades
+      by_server = {}
+      if trades.server is not None:
+         by_server[trades.server] = {DEMAND: trades.demands, OFFER: trades.offers}
+      else:
+         for server in self._entries:
+            by_server[server] = {DEMAND: [], OFFER: []}
+         for type_, new_trades in ((DEMAND, trades.demands), (OFFER, trades.offers)):
+            for t in new_trades:
+               by_server.setdefault(t.server, {DEMAND: [], OFFER: []})[type_].append(t)
+
+      added = []
+      removed = []
+
+      for server, server_trades in by_server.items():
+         server_entries = self._server_entries(server)
+
+         for type_, new_trades in server_trades.items():
+            entries = server_entries[type_]
+            present = set(new_trades)
+
+            for t in new_trades:
+               entry = entries.get(t)
+               if entry is None:
+                  added.append((type_, t))
+               elif entry[0].count != t.count:
+                  removed.append((type_, entry[0]))
+                  added.append((type_, t))
+
+            removed.extend((type_, t) for t in entries if t not in present)
+
+      self.apply(added, removed)
+      self.loaded = True
+
+      return added, removed
+
+   def apply(self, added, removed):
+      if added or removed:
+         self.version += 1
+
+      dirty = set()
+
+      for type_, trade in removed:
+         trade, item_key, key, trade_hash = self._entries[trade.server][type_].pop(trade)
+
+         same_hash = self._hashes[trade_hash]
+         same_hash.remove(trade)
+         if not same_hash:
+            del self._hashes[trade_hash]
+
+         book = self.items[item_key]
+         book.side(type_).remove(key)
+         if not book:
+            del self.items[item_key]
+
+         dirty.add(item_key)
+
+      for type_, trade in added:
+         item_key = trade.book_key
+         book = self.items.get(item_key)
+         if book is None:
+            book = self.items[item_key] = ItemBook()
+
+         key = book.side(type_).add(trade, next(self._seq))
+         trade_hash = get_trade_hash(trade)
+         self._server_entries(trade.server)[type_][trade] = (trade, item_key, key, trade_hash)
+         self._hashes.setdefault(trade_hash, []).append(trade)
+
+         dirty.add(item_key)
+
+      for item_key in dirty:
+         book = self.items.get(item_key)
+         dupes = book.match() if book is not None else None
+         if dupes:
+            self.dupes[item_key] = dupes
+         else:
+            self.dupes.pop(item_key, None)
+
+   def get_dupes(self, ignore_trades=None, server=None):
+      if not ignore_trades:
+         return [
+            d
+            for item_key, item_dupes in self.dupes.items()
+            if server is None or item_key[0] == server
+            for d in item_dupes
+         ], []
+
+      ignored = []
+      skip = set()
+      affected = set()
+
+      if not isinstance(ignore_trades, (set, frozenset)):
+         ignore_trades = set(ignore_trades)
+
+      for trade_hash in ignore_trades:
+         trades = self._hashes.get(trade_hash)
+         if not trades:
+            continue
+
+         ignored.append(trade_hash)
+         for trade in trades:
+            skip.add(trade)
+            affected.add(trade.book_key)
+
+      dupes = []
+      for item_key, item_dupes in self.dupes.items():
+         if server is not None and item_key[0] != server:
+            continue
+         if item_key in affected:
+            item_dupes = self.items[item_key].match(skip=skip)
+         dupes.extend(item_dupes)
+
+      return dupes, ignored
+
+   def snapshot(self, ignore_trades=None):
+      if self._snapshot is None or self._snapshot.version != self.version:
+         dupes, _ = self.get_dupes()
+         self._snapshot = Snapshot(self.version, dupes)
+         self._ignore_snapshots.clear()
+
+      if not ignore_trades:
+         return self._snapshot
+
+      # Only hashes present in the book change the result, so clients with long lists
+      # of long gone trades share a snapshot
+      ignore = frozenset(h for h in set(ignore_trades) if h in self._hashes)
+      if not ignore:
+         return self._snapshot
+
+      snapshot = self._ignore_snapshots.get(ignore)
+      if snapshot is None:
+         dupes, ignored = self.get_dupes(ignore)
+         snapshot = self._ignore_snapshots[ignore] = Snapshot(self.version, dupes, ignored)
+         if len(self._ignore_snapshots) > IGNORE_SNAPSHOTS:
+            self._ignore_snapshots.popitem(last=False)
+      else:
+         self._ignore_snapshots.move_to_end(ignore)
+      return snapshot
+
+
+MARKET = MarketBook()
+
+
+def get_market():
+   if not MARKET.loaded:
+      MARKET.sync(market.get_trades())
+   return MARKET
+
 
-         dupe = Dupe(demand, offer)
-         if dupe.buy_count:
-            dupes.append(dupe)
+def get_dupes(ignore_trades=None, server=None):
+   return get_market().get_dupes(ignore_trades, server=server)
 
-            demand.count -= dupe.buy_count
-            offer.count -= dupe.buy_count
 
-   return dupes, ignored
+def get_snapshot(ignore_trades=None):
+   return get_market().snapshot(ignore_trades)
@@ -0,0 +1,269 @@
+# encoding: utf-8
+
+import os
+import sys
+import gzip
+import zlib
+import argparse
+import datetime
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import market
+
+
+ARCHIVE_DIR = 'pages'  # next to SQLITE_DB_FILENAME
+ARCHIVE_GZIP_LEVEL = 9  # page is compressed once and read only on rebuild
+
+REBUILD_BATCH_ROWS = 50000  # parsed rows staged and inserted at once
+REBUILD_WINDOW = 4  # pages parsed ahead per worker
+
+
+class PageArchive:
+    # Every fetched market page, gzipped and stored once by digest of its raw bytes:
+    # `pages/ab/ab12...ef.gz`. The `pages` table lists fetches in order, many of them
+    # may point to the same file.
+
+    def __init__(self, directory=ARCHIVE_DIR, filename=market.SQLITE_DB_FILENAME):
+        self.directory = directory
+        self.filename = filename
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.gz')
+
+    @staticmethod
+    def compressor():
+        # gzip stream of one page, it is fed with chunks while the page is downloaded
+        return zlib.compressobj(ARCHIVE_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def put(self, server, type_, digest, gz_data, charset, fetched=None):
+        # `gz_data` is the page compressed by `compressor()`
+        if fetched is None:
+            fetched = datetime.datetime.now()
+
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(gz_data)
+            os.replace(tmp_path, path)
+
+        with market.sqlite_conn(filename=self.filename) as conn:
+            if conn.execute('SELECT 1 FROM `pages` LIMIT 1').fetchone() is None:
+                market.mark_archive_start(conn.cursor())
+            conn.execute(
+                'INSERT INTO `pages` (`server`, `type`, `fetched`, `digest`, `charset`) VALUES (?, ?, ?, ?, ?)',
+                (server, type_, fetched, digest, charset)
+            )
+
+    def read(self, digest, charset):
+        with gzip.open(self.path(digest), 'rb') as f:
+            return f.read().decode(charset)
+
+    def entries(self):
+        # (server, type, digest, charset) of every fetch, oldest first
+        with market.sqlite_conn(filename=self.filename, readonly=True) as conn:
+            return conn.execute(
+                'SELECT `server`, `type`, `digest`, `charset` FROM `pages` ORDER BY `id`'
+            ).fetchall()
+
+
+def parse_page(archive, server, type_, digest, charset):
+    # Page as rows of history tables, runs in worker process
+    trades = market.TradeList._read_trades(archive.read(digest, charset), server=server)
+    return [market.trade_row(type_, t) for t in trades]
+
+
+def _iter_parsed(executor, archive, entries, window):
+    # Parsed pages in order of `entries`, at most `window` of them are in flight
+    pending = collections.deque()
+    for entry in entries:
+        pending.append(executor.submit(parse_page, archive, *entry))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _save_keys(cur, tables):
+    # Keys of rows collected before the first archived page, see market.mark_archive_start
+    cur.execute(
+        '''
+        CREATE TEMP TABLE IF NOT EXISTS `rebuild_history` (
+            `table` VARCHAR,
+            `server`    VARCHAR,
+            `date`  DATETIME,
+            `owner_name`    VARCHAR,
+            `mod`   VARCHAR,
+            `cost`  INTEGER,
+            `item_id`   INTEGER
+        )
+        '''
+    )
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS `rebuild_owners` (`server` VARCHAR, `name` VARCHAR)')
+    for table in ('rebuild_history', 'rebuild_owners'):
+        cur.execute('DELETE FROM temp.`%s`' % table)
+
+    marks = dict(cur.execute('SELECT `table`, `max_id` FROM `archive_start`'))
+    for table in tables:
+        if table in marks:
+            cur.execute(
+                '''
+                INSERT INTO temp.`rebuild_history`
+                SELECT ?, `server`, `date`, `owner_name`, `mod`, `cost`, `item_id` FROM `%s` WHERE `id` <= ?
+                ''' % table,
+                (table, marks[table])
+            )
+    if 'owners' in marks:
+        cur.execute(
+            'INSERT INTO temp.`rebuild_owners` SELECT `server`, `name` FROM `owners` WHERE `id` <= ?',
+            (marks['owners'],)
+        )
+
+
+def _check_rebuilt(cur, tables):
+    # Raises when rows collected before the first archived page are missing after rebuild,
+    # rows of archived pages may be changed by the parser fix the rebuild is made for.
+    # Daily buckets which were there outlive compacted history, they are checked too.
+    lost_history = 0
+    for table in tables:
+        lost_history += cur.execute(
+            '''
+            SELECT COUNT(*) FROM temp.`rebuild_history` AS `k`
+            WHERE `k`.`table` = ? AND NOT EXISTS (
+                SELECT 1 FROM `%s` AS `t` WHERE `t`.`server` = `k`.`server` AND `t`.`date` IS `k`.`date`
+                    AND `t`.`owner_name` = `k`.`owner_name` AND `t`.`mod` IS `k`.`mod`
+                    AND `t`.`cost` = `k`.`cost` AND `t`.`item_id` IS `k`.`item_id`
+            )
+            ''' % table,
+            (table,)
+        ).fetchone()[0]
+    lost_rollups = cur.execute(
+        '''
+        SELECT COUNT(*) FROM `archive_start_rollups` AS `k` WHERE NOT EXISTS (
+            SELECT 1 FROM `rollups` AS `r` WHERE `r`.`server` = `k`.`server` AND `r`.`item_id` = `k`.`item_id`
+                AND `r`.`period` = ? AND `r`.`type` = `k`.`type` AND `r`.`mod` = `k`.`mod`
+                AND `r`.`bucket` = `k`.`bucket`
+        )
+        ''',
+        (max(market.ROLLUP_PERIODS),)
+    ).fetchone()[0]
+    lost_owners = cur.execute(
+        '''
+        SELECT COUNT(*) FROM temp.`rebuild_owners` AS `k` WHERE NOT EXISTS (
+            SELECT 1 FROM `owners` AS `o` WHERE `o`.`server` = `k`.`server` AND `o`.`name` = `k`.`name`
+        )
+        '''
+    ).fetchone()[0]
+
+    if lost_history or lost_rollups or lost_owners:
+        raise RuntimeError(
+            '%d history rows, %d daily price buckets and %d owners collected before the archive was started '
+            'would be lost, nothing is rebuilt' % (lost_history, lost_rollups, lost_owners)
+        )
+
+
+def rebuild(archive=None, workers=None, batch_rows=REBUILD_BATCH_ROWS):
+    # Replay archived pages through the current parser and write history, rollups and book
+    # from scratch, as if every page was scraped again in the same order. History of all
+    # archived months is restored, then compacted by retention like the crawler does.
+    # Refuses when trades collected before the first archived page would be lost.
+    if archive is None:
+        archive = PageArchive()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    version = market.get_schema_version(archive.filename)
+    if version < market.SCHEMA_VERSION:
+        raise RuntimeError(
+            'Database schema is at version %d of %d, run migrate.py before rebuild' % (version, market.SCHEMA_VERSION)
+        )
+
+    entries = archive.entries()
+
+    # a page reappearing later adds nothing new to history, it is parsed once
+    seen = set()
+    history_entries = []
+    latest = {}  # (server, type) -> entry, current book
+    for entry in entries:
+        server, type_, _, _ = entry
+        latest[server, type_] = entry
+        if entry not in seen:
+            seen.add(entry)
+            history_entries.append(entry)
+
+    pages = rows_count = inserted = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            market.sqlite_conn(filename=archive.filename) as conn:
+        cur = conn.cursor()
+
+        # without any archived page everything in the database is collected before it
+        if not entries:
+            market.mark_archive_start(cur)
+        # Tables are emptied, not dropped: DDL is not a part of the transaction, which is rolled
+        # back when the archive does not cover the database, see _check_rebuilt
+        tables = market.history_tables(cur)
+        _save_keys(cur, tables)
+        for table in tables + ['book', 'rollups', 'rollup_costs', 'owners']:
+            cur.execute('DELETE FROM `%s`' % table)
+
+        rows = []
+        book = {}  # entry -> rows, latest pages are parsed along with history
+        latest_entries = set(latest.values())
+        parsed = _iter_parsed(executor, archive, history_entries, workers * REBUILD_WINDOW)
+        for entry, page_rows in zip(history_entries, parsed):
+            pages += 1
+            rows.extend(page_rows)
+            if entry in latest_entries:
+                book[entry] = page_rows
+            if len(rows) >= batch_rows:
+                market.TradeList._stage_rows(cur, rows)
+                inserted += market.TradeList._insert_staged(cur, first_month='')
+                rows_count += len(rows)
+                rows = []
+
+        if rows:
+            market.TradeList._stage_rows(cur, rows)
+            inserted += market.TradeList._insert_staged(cur, first_month='')
+            rows_count += len(rows)
+
+        for page_rows in book.values():
+            market.TradeList._stage_rows(cur, page_rows)
+            market.TradeList._insert_book(cur)
+
+        _check_rebuilt(cur, tables)
+        # everything is restored from the archive now
+        cur.execute('DELETE FROM `archive_start`')
+        cur.execute('DELETE FROM `archive_start_rollups`')
+
+    dropped = market.compact_history(market.HISTORY_RETENTION_MONTHS, filename=archive.filename)
+    return {
+        'fetches': len(entries),
+        'pages': pages,
+        'rows': rows_count,
+        'inserted': inserted,
+        'dropped': dropped,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Market page archive')
+    parser.add_argument('command', choices=('rebuild',))
+    parser.add_argument('--workers', type=int, default=None, help='parser processes, cpu count by default')
+    parser.add_argument('--batch', type=int, default=REBUILD_BATCH_ROWS, help='rows inserted at once')
+    args = parser.parse_args(argv)
+
+    if args.command == 'rebuild':
+        result = rebuild(workers=args.workers, batch_rows=args.batch)
+        print('%(fetches)d fetches, %(pages)d pages parsed, %(rows)d rows, %(inserted)d trades in history' % result)
+        if result['dropped']:
+            print('compacted: %s' % ', '.join(result['dropped']))
+
+    market.close_db()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,460 @@
+# encoding: utf-8
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import urllib.request
+
+import market
+import migrate
+import analyze
+import columnar
+
+
+SELF_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(SELF_DIR, 'fixtures')
+BASELINE_FILENAME = os.path.join(SELF_DIR, 'bench_baseline.json')
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+MIGRATION_CHECK_ROWS = 20000  # half of them is old history, the rest is written during migration
+MIGRATION_CHECK_SCRAPE = 200  # rows written after every migration step
+REGRESSION_THRESHOLD = 0.2  # slower by 20% and more
+
+CITIES = (
+    'Giran x:83400 y:147900',
+    'Aden x:147450 y:26741',
+    'Goddard x:147928 y:-55273',
+    'Rune x:43799 y:-47727',
+    'Oren x:82956 y:53162',
+)
+
+ROW_TEMPLATE = (
+    '<tr class="list0{parity}">'
+    '<td class="date">{date}</td>'
+    '<td>{owner}<br/>{city}</td>'
+    '<td><img src="/img/{item_id}.png" alt=""></td>'
+    '<td><span>{name}</span><br>{name_ru}{mod}</td>'
+    '<td>&nbsp;</td>'
+    '<td align="right">{count}</td>'
+    '<td>&nbsp;</td>'
+    '<td align="right">{cost}</td>'
+    '</tr>\n'
+)
+PAGE_HEAD = (
+    '<html><head><meta charset="utf-8"><title>Market</title></head><body><table>\n'
+    '<tr class="list00"><td>Date</td><td>Owner</td><td></td><td>Item</td>'
+    '<td></td><td>Count</td><td></td><td>Price</td></tr>\n'
+)
+PAGE_TAIL = '</table></body></html>\n'
+
+
+def synthetic_trades(rows, seed=0, items=None):
+    rnd = random.Random(seed)
+    if items is None:
+        items = max(10, rows // 20)
+
+    base_date = datetime.datetime(2015, 7, 1)
+    prices = [rnd.randint(1, 5000) * 1000 for _ in range(items)]
+
+    demands = []
+    offers = []
+    for i in range(rows):
+        item_idx = rnd.randrange(items)
+        # quotes around item price, a few of them cross each other
+        cost = max(1, int(prices[item_idx] * rnd.gauss(1, 0.05)))
+        trade = market.Trade(
+            base_date + datetime.timedelta(seconds=rnd.randrange(30 * 24 * 3600)),
+            'Trader%d' % rnd.randrange(rows // 5 + 1),
+            rnd.choice(CITIES),
+            'Item %d' % (item_idx + 1),
+            rnd.choice(('', '', '', '+3', '+10')),
+            rnd.randint(1, 20),
+            cost,
+            item_idx + 1,
+        )
+        (demands if i % 2 else offers).append(trade)
+
+    return market.TradeList(demands=demands, offers=offers)
+
+
+def render_page(trades):
+    parts = [PAGE_HEAD]
+    for i, t in enumerate(trades):
+        parts.append(ROW_TEMPLATE.format(
+            parity=1 + i % 2,
+            date=t.date.strftime('%m/%d/%Y %I:%M:%S %p'),
+            owner=t.owner_name,
+            city=t.city,
+            item_id=t.item_id,
+            name=t._item_name,
+            name_ru=t._item_name,
+            mod='<br>%s' % t.mod if t.mod else '',
+            count=t.count,
+            cost='{:,}'.format(t.cost).replace(',', '.'),
+        ))
+    parts.append(PAGE_TAIL)
+    return ''.join(parts)
+
+
+def iter_chunks(page, size=market.PAGE_CHUNK_SIZE):
+    for i in range(0, len(page), size):
+        yield page[i:i + size]
+
+
+def init_db(trades):
+    market.sqlite_init_items()
+    market.sqlite_init_trades()
+    market.sqlite_init_rollups()
+
+    item_ids = {t.item_id for t in trades.demands + trades.offers}
+    with market.sqlite_conn() as conn:
+        conn.executemany(
+            'INSERT INTO items (id, name) VALUES (?, ?)',
+            ((item_id, 'Item %d' % item_id) for item_id in item_ids)
+        )
+
+
+def build_book(trades):
+    book = analyze.MarketBook()
+    book.sync(trades)
+    return book
+
+
+def clear_trades():
+    with market.sqlite_conn() as conn:
+        cur = conn.cursor()
+        for table in market.history_tables(cur):
+            cur.execute('DROP TABLE `%s`' % table)
+        for table in ('book', 'rollups', 'rollup_costs', 'owners'):
+            cur.execute('DELETE FROM `%s`' % table)
+
+
+def measure(name, rows, func, setup=None):
+    # tracing allocations slows code down several times, so time and memory are separate runs
+    if setup is not None:
+        setup()
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        'name': name,
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_sec': rows / elapsed if elapsed else float('inf'),
+        'peak_kb': peak // 1024,
+    }
+
+
+def run_size(rows, seed=0):
+    results = []
+    trades = synthetic_trades(rows, seed=seed)
+    page = render_page(trades.offers)
+    offers_count = len(trades.offers)
+
+    _, res = measure('parse', offers_count, lambda: market.TradeList._read_trades(iter_chunks(page)))
+    results.append(res)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            init_db(trades)
+            _, res = measure('write', rows, lambda: trades.write(latest=True), setup=clear_trades)
+            results.append(res)
+
+            local, res = measure('from_local', rows, market.TradeList.from_local)
+            results.append(res)
+
+            if columnar.numpy is not None:
+                columns, res = measure('columnar_load', rows, columnar.TradeColumns.from_local)
+                results.append(res)
+
+            # matching is done by sync, so the book is built from scratch, as `columnar_dupes` does
+            (dupes, _), res = measure('get_dupes', rows, lambda: build_book(local).get_dupes())
+            results.append(res)
+
+            if columnar.numpy is not None:
+                _, res = measure('columnar_dupes', rows, lambda: columnar.find_dupes(columns))
+                results.append(res)
+
+            # item names are resolved from catalog of db on rendering
+            _, res = measure('json', len(dupes), lambda: json.dumps([d.to_dict() for d in dupes]).encode())
+            results.append(res)
+        finally:
+            market.close_db()
+            os.chdir(cwd)
+
+    return results
+
+
+def create_legacy_db(trades, seed=0):
+    # Oldest layout migrate.py upgrades: single `trades` table, current book is flagged by `latest`
+    rnd = random.Random(seed)
+    with market.sqlite_conn() as conn:
+        cur = conn.cursor()
+        market.create_items_table(cur)
+        cur.executemany(
+            'INSERT OR IGNORE INTO `items` (`id`, `name`) VALUES (?, ?)',
+            ((t.item_id, t._item_name) for t in trades.demands + trades.offers)
+        )
+        cur.execute(
+            '''
+            CREATE TABLE "trades" (
+                `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                `item_name` VARCHAR,
+                `mod` VARCHAR,
+                `owner_name`    VARCHAR,
+                `count` INTEGER,
+                `cost`  INTEGER,
+                `city`  VARCHAR,
+                `type`  INTEGER,
+                `date`  DATETIME,
+                `latest`    BOOLEAN DEFAULT 0,
+                `item_id` REFERENCES items(id)
+            )
+            '''
+        )
+        cur.execute('CREATE UNIQUE INDEX iTrade ON `trades` (`date`, `owner_name`, `mod`, `cost`, `item_id`)')
+        cur.executemany(
+            '''
+            INSERT OR IGNORE INTO `trades` (
+                `item_name`, `mod`, `owner_name`, `count`, `cost`, `city`, `type`, `date`, `latest`, `item_id`
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (
+                # spread over several months
+                (t._item_name, t.mod, t.owner_name, t.count, t.cost, t.city, type_,
+                 t.date + datetime.timedelta(days=rnd.randrange(90)), rnd.random() < 0.2, t.item_id)
+                for type_, typed in ((1, trades.demands), (2, trades.offers)) for t in typed
+            )
+        )
+
+
+def check_migrations(rows=MIGRATION_CHECK_ROWS, scrape_rows=MIGRATION_CHECK_SCRAPE, batch_size=1000, seed=0):
+    # Upgrade a database of the oldest layout while a scrape is written after every migration step,
+    # like the crawler does. Returns problems found in the result, every written row must be there.
+    history = synthetic_trades(rows // 2, seed=seed)
+    scraped = synthetic_trades(rows - rows // 2, seed=seed + 1)
+    scrapes = [
+        market.TradeList(demands=scraped.demands[i:i + scrape_rows // 2], offers=scraped.offers[i:i + scrape_rows // 2])
+        for i in range(0, len(scraped.demands), scrape_rows // 2)
+    ]
+    for scrape in scrapes:
+        scrape.server = market.DEFAULT_SERVER
+
+    written = []
+
+    def write_scrape(migration, state):
+        if len(written) < len(scrapes):
+            scrape = scrapes[len(written)]
+            scrape.write(latest=True)
+            written.append(scrape)
+
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            create_legacy_db(history, seed=seed)
+            with market.sqlite_conn(readonly=True) as conn:
+                expected = {
+                    (market.DEFAULT_SERVER, date, owner_name, mod, cost, item_id)
+                    for date, owner_name, mod, cost, item_id in conn.execute(
+                        'SELECT `date` as "[timestamp]", `owner_name`, `mod`, `cost`, `item_id` FROM `trades`'
+                    )
+                }
+
+            migrate.migrate(batch_size=batch_size, pause=0, on_step=write_scrape)
+            for scrape in scrapes[len(written):]:
+                scrape.write(latest=True)
+            for scrape in scrapes:
+                expected.update(
+                    (t.server, t.date, t.owner_name, t.mod, t.cost, t.item_id) for t in scrape.demands + scrape.offers
+                )
+
+            problems = _check_migrated(expected)
+        finally:
+            market.close_db()
+            os.chdir(cwd)
+
+    return problems
+
+
+def _check_migrated(expected):
+    problems = []
+    # recomputed from scratch and rolled back
+    with market.sqlite_conn(autocommit=False) as conn:
+        cur = conn.cursor()
+        tables = market.history_tables(cur)
+
+        found = set()
+        for table in tables:
+            found.update(cur.execute(
+                'SELECT `server`, `date` as "[timestamp]", `owner_name`, `mod`, `cost`, `item_id` FROM `%s`' % table
+            ))
+            nulls = cur.execute(
+                'SELECT COUNT(*) FROM `%s` WHERE `owner_id` IS NULL OR `fingerprint` IS NULL' % table
+            ).fetchone()[0]
+            if nulls:
+                problems.append('%s: %d rows without owner or fingerprint' % (table, nulls))
+        if found != expected:
+            problems.append('history: %d rows lost, %d unexpected' % (len(expected - found), len(found - expected)))
+
+        # open and close depend on the order of rows with the same date, the rest must be equal
+        rollups_sql = '''
+            SELECT `server`, `item_id`, `period`, `type`, `mod`, `bucket`, `high`, `low`, `median`, `volume`, `trades`
+            FROM `rollups` ORDER BY 1, 2, 3, 4, 5, 6
+            '''
+        # undercuts depend on rollups at the time of write, other totals must be equal
+        owners_sql = '''
+            SELECT `server`, `name`, `first_date`, `last_date`, `demands`, `offers`, `demand_volume`, `offer_volume`
+            FROM `owners` ORDER BY 1, 2
+            '''
+        rollups = cur.execute(rollups_sql).fetchall()
+        owners = cur.execute(owners_sql).fetchall()
+
+        cur.execute('DELETE FROM `rollups`')
+        cur.execute('DELETE FROM `rollup_costs`')
+        cur.execute(
+            '''
+            UPDATE `owners` SET `first_date` = NULL, `last_date` = NULL, `demands` = 0, `offers` = 0,
+                `demand_volume` = 0, `offer_volume` = 0
+            '''
+        )
+        for table in tables:
+            market.update_rollups(cur, table, 0)
+            market.update_owners(cur, table, 0)
+
+        if cur.execute(rollups_sql).fetchall() != rollups:
+            problems.append('rollups differ from the ones computed from scratch')
+        if cur.execute(owners_sql).fetchall() != owners:
+            problems.append('owners differ from the ones computed from scratch')
+
+    return problems
+
+
+def run_fixtures():
+    results = []
+    if not os.path.isdir(FIXTURES_DIR):
+        return results
+
+    for filename in sorted(os.listdir(FIXTURES_DIR)):
+        if not filename.endswith('.html'):
+            continue
+
+        with open(os.path.join(FIXTURES_DIR, filename), encoding='utf-8') as f:
+            page = f.read()
+
+        trades, res = measure(
+            'parse:%s' % filename, 0, lambda: market.TradeList._read_trades(iter_chunks(page))
+        )
+        res['rows'] = len(trades)
+        res['rows_per_sec'] = res['rows'] / res['seconds'] if res['seconds'] else float('inf')
+        results.append(res)
+
+    return results
+
+
+def record_fixtures():
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for filename, url in (('buy.html', market.TradeList.demands_url), ('sell.html', market.TradeList.offers_url)):
+        with urllib.request.urlopen(url, timeout=60) as resp:
+            page = resp.read().decode(resp.headers.get_content_charset('utf-8'))
+        with open(os.path.join(FIXTURES_DIR, filename), 'w', encoding='utf-8') as f:
+            f.write(page)
+        print('recorded %s (%d bytes)' % (filename, len(page)))
+
+
+def result_key(res):
+    return '%s/%s' % (res['name'], res['rows'])
+
+
+def print_results(results, baseline=None):
+    regressions = []
+    print('%-28s %9s %10s %14s %10s %9s' % ('benchmark', 'rows', 'seconds', 'rows/s', 'peak KB', 'change'))
+
+    for res in results:
+        change = ''
+        base = (baseline or {}).get(result_key(res))
+        if base and base['seconds']:
+            ratio = res['seconds'] / base['seconds'] - 1
+            change = '%+.0f%%' % (ratio * 100)
+            if ratio > REGRESSION_THRESHOLD:
+                change += ' !'
+                regressions.append(res)
+
+        print('%-28s %9d %10.4f %14.0f %10d %9s' % (
+            res['name'], res['rows'], res['seconds'], res['rows_per_sec'], res['peak_kb'], change
+        ))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Parser, scrape and analyze benchmarks')
+    parser.add_argument(
+        '--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+        help='comma separated synthetic market sizes, rows (up to 1000000)',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FILENAME)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as baseline')
+    parser.add_argument('--record', action='store_true', help='record live buy/sell pages as fixtures')
+    parser.add_argument(
+        '--migrations', action='store_true', help='check that scrapes are kept when written during migrations',
+    )
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_fixtures()
+        return 0
+
+    # synthetic market is dated 2015, it must not be dropped from history as expired
+    market.HISTORY_RETENTION_MONTHS = None
+
+    if args.migrations:
+        problems = check_migrations(seed=args.seed)
+        for problem in problems:
+            print(problem)
+        print('migrations: %s' % ('%d problem(s)' % len(problems) if problems else 'ok'))
+        return 1 if problems else 0
+
+    results = run_fixtures()
+    for rows in (int(s) for s in args.sizes.split(',') if s):
+        results.extend(run_size(rows, seed=args.seed))
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({result_key(res): res for res in results}, f, indent=2, sort_keys=True)
+        print('baseline saved to %s' % args.baseline)
+    elif regressions:
+        print('%d regression(s) against baseline' % len(regressions))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+# encoding: utf-8
+
+import array
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # columnar backend is optional, analyze.MarketBook works without it
+
+import market
+import analyze
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# name -> array typecode, dates are seconds since EPOCH, missing item_id is -1
+COLUMNS = (
+    ('item', 'l'),
+    ('item_id', 'q'),
+    ('owner', 'l'),
+    ('city', 'l'),
+    ('side', 'b'),
+    ('bulk', 'b'),
+    ('date', 'q'),
+    ('count', 'q'),
+    ('cost', 'q'),
+)
+
+
+class _Codes(dict):
+    # value -> integer code, `values` are ordered by code
+    def __init__(self):
+        super().__init__()
+        self.values = []
+
+    def code(self, value):
+        code = self.get(value)
+        if code is None:
+            code = self[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class TradeColumns:
+    # Trades as typed arrays, one element per trade in load order. Strings are kept once
+    # in code tables: `items` holds `Trade.book_key` tuples (server, item id, mod level),
+    # `owners` and `cities` hold names. Item code is the book key of MarketBook.
+
+    def __init__(self):
+        if numpy is None:
+            raise RuntimeError('numpy is required for columnar backend')
+
+        self.servers = _Codes()
+        self.items = _Codes()
+        self._item_info = []  # item code -> (item name or None, mod)
+        self.owners = _Codes()
+        self.cities = _Codes()
+
+        self._arrays = {name: array.array(typecode) for name, typecode in COLUMNS}
+        self._frozen = False
+
+    def __len__(self):
+        return len(self.cost) if self._frozen else len(self._arrays['cost'])
+
+    def append(self, server, item_name, mod, item_id, owner_name, city, type_, date, count, cost, bulk=False):
+        self.servers.code(server)
+        arrays = self._arrays
+        item = self.items.code((server, item_name if item_id is None else item_id, market.mod_level(mod)))
+        if item == len(self._item_info):
+            self._item_info.append((item_name, mod))
+        arrays['item'].append(item)
+        arrays['item_id'].append(-1 if item_id is None else item_id)
+        arrays['owner'].append(self.owners.code(owner_name))
+        arrays['city'].append(self.cities.code(city))
+        arrays['side'].append(type_)
+        arrays['bulk'].append(bulk)
+        arrays['date'].append(date)
+        arrays['count'].append(count)
+        arrays['cost'].append(cost)
+
+    def freeze(self):
+        for name, _ in COLUMNS:
+            setattr(self, name, numpy.array(self._arrays.pop(name)))
+        self.bulk = self.bulk.astype(bool)
+
+        server_codes = self.servers
+        self.item_server = numpy.array(
+            [server_codes[server] for server, _, _ in self.items.values], dtype=numpy.int64
+        )
+        self._frozen = True
+        return self
+
+    def trade(self, row):
+        item = self.item[row]
+        server = self.items.values[item][0]
+        item_name, mod = self._item_info[item]
+        item_id = int(self.item_id[row])
+        return market.Trade(
+            EPOCH + datetime.timedelta(seconds=int(self.date[row])),
+            self.owners.values[self.owner[row]],
+            self.cities.values[self.city[row]],
+            item_name,
+            mod,
+            int(self.count[row]),
+            int(self.cost[row]),
+            item_id=None if item_id == -1 else item_id,
+            bulk=bool(self.bulk[row]),
+            server=server,
+        )
+
+    @classmethod
+    def from_trades(cls, trades):
+        # TradeList (e.g. replayed from old pages) to columns, demands go first like in MarketBook.sync
+        columns = cls()
+        for type_, typed_trades in ((analyze.DEMAND, trades.demands), (analyze.OFFER, trades.offers)):
+            for t in typed_trades:
+                columns.append(
+                    t.server, t._item_name, t.mod, t.item_id, t.owner_name, t.city, type_,
+                    int((t.date - EPOCH).total_seconds()), t.count, t.cost, bulk=t.bulk,
+                )
+        return columns.freeze()
+
+    @classmethod
+    def from_local(cls, latest_only=True, server=None):
+        # Same rows as TradeList.from_local, but without a Trade object per row
+        columns_sql = '''
+            `server`,
+            `mod`,
+            `item_id`,
+            `owner_name`,
+            `city`,
+            `type`,
+            CAST(strftime('%s', `date`) AS INTEGER),
+            `count`,
+            `cost`
+            '''
+
+        columns = cls()
+        append = columns.append
+        with market.sqlite_conn(readonly=True) as conn:
+            rows = market.select_trades(conn.cursor(), columns_sql, latest_only=latest_only, server=server)
+            for server_, mod, item_id, owner_name, city, type_, date, count, cost in rows:
+                if type_ not in (analyze.DEMAND, analyze.OFFER):
+                    raise NotImplementedError
+                if item_id is None:
+                    continue
+                append(server_, None, mod or '', item_id, owner_name, city, type_, date, count, cost)
+        return columns.freeze()
+
+
+def _match(bid_cost, bid_count, ask_cost, ask_count):
+    # ItemBook.match over the crossed part of one book, arguments are lists sorted like book sides
+    matched = []
+    ask_idx = 0
+    ask_left = 0
+    ask = None
+
+    for bid in range(len(bid_cost)):
+        bid_left = bid_count[bid]
+        while bid_left:
+            while not ask_left and ask_idx < len(ask_cost):
+                ask = ask_idx
+                ask_idx += 1
+                ask_left = ask_count[ask]
+
+            if not ask_left or ask_cost[ask] >= bid_cost[bid]:
+                return matched
+
+            buy_count = min(bid_left, ask_left)
+            matched.append((bid, ask, buy_count))
+            bid_left -= buy_count
+            ask_left -= buy_count
+
+    return matched
+
+
+def find_dupes(columns, server=None):
+    # Same dupes as MarketBook.get_dupes(). Crossed books are found with grouped array
+    # operations, only quotes which cross the opposite best price are walked in Python.
+    if not len(columns):
+        return []
+
+    item = columns.item
+    cost = columns.cost
+    n_items = len(columns.items.values)
+
+    is_bid = columns.side == analyze.DEMAND
+    is_ask = columns.side == analyze.OFFER
+
+    best_bid = numpy.zeros(n_items, dtype=numpy.int64)  # costs are positive
+    numpy.maximum.at(best_bid, item[is_bid], cost[is_bid])
+    best_ask = numpy.full(n_items, numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+    numpy.minimum.at(best_ask, item[is_ask], cost[is_ask])
+
+    crossed = best_bid > best_ask
+    if server is not None:
+        if server not in columns.servers:
+            return []
+        crossed &= columns.item_server == columns.servers[server]
+    if not crossed.any():
+        return []
+
+    row_crossed = crossed[item]
+    # bulk asks make a book crossed, but can not be bought partially and are never matched
+    bids = numpy.flatnonzero(is_bid & row_crossed & (cost > best_ask[item]))
+    asks = numpy.flatnonzero(is_ask & row_crossed & (cost < best_bid[item]) & ~columns.bulk)
+
+    # book side order: by price, then bigger count first, then load order
+    bids = bids[numpy.lexsort((bids, -columns.count[bids], -cost[bids], item[bids]))]
+    asks = asks[numpy.lexsort((asks, -columns.count[asks], cost[asks], item[asks]))]
+
+    crossed_items = numpy.flatnonzero(crossed)
+    bid_items = item[bids]
+    ask_items = item[asks]
+    bid_bounds = zip(
+        numpy.searchsorted(bid_items, crossed_items).tolist(),
+        numpy.searchsorted(bid_items, crossed_items, side='right').tolist(),
+    )
+    ask_bounds = zip(
+        numpy.searchsorted(ask_items, crossed_items).tolist(),
+        numpy.searchsorted(ask_items, crossed_items, side='right').tolist(),
+    )
+
+    bid_rows = bids.tolist()
+    bid_cost = cost[bids].tolist()
+    bid_count = columns.count[bids].tolist()
+    ask_rows = asks.tolist()
+    ask_cost = cost[asks].tolist()
+    ask_count = columns.count[asks].tolist()
+
+    trades = {}  # row -> Trade, only matched rows are turned into objects
+
+    def get_trade(row):
+        trade = trades.get(row)
+        if trade is None:
+            trade = trades[row] = columns.trade(row)
+        return trade
+
+    dupes = []
+    for (bid_start, bid_end), (ask_start, ask_end) in zip(bid_bounds, ask_bounds):
+        matched = _match(
+            bid_cost[bid_start:bid_end], bid_count[bid_start:bid_end],
+            ask_cost[ask_start:ask_end], ask_count[ask_start:ask_end],
+        )
+        for bid, ask, buy_count in matched:
+            dupes.append(analyze.Dupe(
+                get_trade(bid_rows[bid_start + bid]), get_trade(ask_rows[ask_start + ask]), buy_count
+            ))
+
+    return dupes
+
+
+def get_dupes(server=None):
+    # Columnar counterpart of analyze.get_dupes() for the whole latest book, no ignore list
+    return find_dupes(TradeColumns.from_local(server=server), server=server)
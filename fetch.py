@@ -0,0 +1,283 @@
+# encoding: utf-8
+
+import re
+import time
+import codecs
+import hashlib
+import random
+import asyncio
+import urllib.parse
+
+import aiohttp
+
+import market
+
+
+FETCH_TIMEOUT = 60
+FETCH_RETRY = 3
+KEEPALIVE_TIMEOUT = 300  # longer than pause between scrapes, so connection survives it
+
+HOST_CONCURRENCY = 4  # simultaneous downloads from one host
+HOST_INTERVAL = 1.0  # seconds between request starts to one host
+HOST_JITTER = 0.5
+
+_rcharset = re.compile(r'charset=["\']?([\w-]+)', flags=re.IGNORECASE)
+
+
+class PageNotModified(Exception):
+    pass
+
+
+def create_session(loop=None):
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(keepalive_timeout=KEEPALIVE_TIMEOUT, loop=loop),
+        loop=loop,
+    )
+
+
+class _HostSlot:
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+
+
+class HostLimiter:
+    def __init__(self, concurrency=HOST_CONCURRENCY, interval=HOST_INTERVAL, jitter=HOST_JITTER, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.concurrency = concurrency
+        self.interval = interval
+        self.jitter = jitter
+
+        self._loop = loop
+        self._semaphores = {}
+        self._next_start = {}  # host -> earliest time of the next request
+
+    @asyncio.coroutine
+    def acquire(self, url):
+        # usage: `with (yield from limiter.acquire(url)): ...`
+        host = urllib.parse.urlsplit(url).netloc
+
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.concurrency, loop=self._loop)
+
+        yield from semaphore.acquire()
+        try:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.interval + random.uniform(0, self.jitter)
+            if start > now:
+                yield from asyncio.sleep(start - now, loop=self._loop)
+        except BaseException:
+            semaphore.release()
+            raise
+
+        return _HostSlot(semaphore)
+
+
+class _PageStream:
+    # Chunks of one downloaded page are tokenized, hashed and compressed for archive here,
+    # in executor, one call at a time
+
+    def __init__(self, charset, compressor=None):
+        self.charset = charset
+        self._decoder = codecs.getincrementaldecoder(charset)()
+        self._parser = market.TradeRowParser()
+        self._digest = hashlib.sha1()  # address of the page in archive as well
+        self._compressor = compressor  # page is kept for archive only compressed, see archive.PageArchive.put
+        self._compressed = []
+        self._rows = []
+
+    def feed(self, chunk):
+        self._digest.update(chunk)
+        if self._compressor is not None:
+            self._compressed.append(self._compressor.compress(chunk))
+        self._parser.feed(self._decoder.decode(chunk))
+        self._rows.extend(self._parser.pop_rows())
+
+    def close(self):
+        self._parser.feed(self._decoder.decode(b'', final=True))
+        self._parser.close()
+        self._rows.extend(self._parser.pop_rows())
+        if self._compressor is not None:
+            self._compressed.append(self._compressor.flush())
+        return self._rows, self._digest.hexdigest(), b''.join(self._compressed), self.charset
+
+
+class MarketFetcher:
+    def __init__(self, server=market.DEFAULT_SERVER, session=None, limiter=None, archive=None, executor=None,
+                 loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.server = server
+        self.demands_url, self.offers_url = market.get_market_urls(server)
+
+        self._loop = loop
+        self._own_session = session is None
+        self._session = create_session(loop) if session is None else session
+        self._limiter = HostLimiter(loop=loop) if limiter is None else limiter
+        self._archive = archive  # archive.PageArchive, modified pages are stored there before parsing
+        self._executor = executor  # pages are parsed there, default executor of the loop if None
+        self._validators = {}  # url -> conditional request headers
+        self._digests = {}  # url -> digest of last page content
+        self._caches = {}  # url -> RowParseCache
+        self._trades = {}  # url -> trades parsed from last modified page
+        self._prev = None  # previous generation, TradeList
+
+    def reset(self):
+        # Forget previous generation, next fetch returns all trades as new
+        self._validators.clear()
+        self._digests.clear()
+        self._caches.clear()
+        self._trades.clear()
+        self._prev = None
+
+    def close(self):
+        if self._own_session:
+            self._session.close()
+
+    def _conditional_headers(self, url):
+        return dict(self._validators.get(url, ()))
+
+    def _remember_validators(self, url, headers):
+        validators = []
+        if headers.get('ETAG'):
+            validators.append(('If-None-Match', headers['ETAG']))
+        if headers.get('LAST-MODIFIED'):
+            validators.append(('If-Modified-Since', headers['LAST-MODIFIED']))
+        self._validators[url] = validators
+
+    @asyncio.coroutine
+    def _request(self, url, retry=FETCH_RETRY):
+        while True:
+            try:
+                resp = yield from asyncio.wait_for(
+                    self._session.get(url, headers=self._conditional_headers(url)),
+                    timeout=FETCH_TIMEOUT,
+                    loop=self._loop,
+                )
+            except (aiohttp.ClientError, aiohttp.HttpProcessingError, asyncio.TimeoutError) as exc:
+                if not retry:
+                    raise
+                retry -= 1
+                print("Error, retry %s: %r" % (retry, exc))
+                continue
+
+            if resp.status == 304:
+                yield from resp.release()
+                raise PageNotModified(url)
+
+            if resp.status >= 500 and retry:
+                yield from resp.release()
+                retry -= 1
+                print("Error, retry %s: HTTP %s" % (retry, resp.status))
+                continue
+
+            if resp.status != 200:
+                yield from resp.release()
+                raise aiohttp.HttpProcessingError(code=resp.status, message=url)
+
+            return resp
+
+    @asyncio.coroutine
+    def fetch_rows(self, url):
+        with (yield from self._limiter.acquire(url)):
+            return (yield from self._fetch_rows(url))
+
+    @asyncio.coroutine
+    def _fetch_rows(self, url):
+        resp = yield from self._request(url)
+        try:
+            mo = _rcharset.search(resp.headers.get('CONTENT-TYPE', ''))
+            page = _PageStream(
+                mo.group(1) if mo else 'utf-8',
+                None if self._archive is None else self._archive.compressor(),
+            )
+
+            # chunk is parsed in executor while the next one is on the way
+            parsing = None
+            while True:
+                chunk = yield from resp.content.read(market.PAGE_CHUNK_SIZE)
+                if parsing is not None:
+                    yield from parsing
+                if not chunk:
+                    break
+                parsing = self._loop.run_in_executor(self._executor, page.feed, chunk)
+
+            result = yield from self._loop.run_in_executor(self._executor, page.close)
+        except BaseException:
+            resp.close(force=True)
+            raise
+        else:
+            resp.close()
+
+        self._remember_validators(url, resp.headers)
+        return result
+
+    def _collect_trades(self, rows, cache):
+        # only rows changed since previous page are parsed into trades
+        trades = market.TradeList._collect_trades(rows, server=self.server, cache=cache)
+        cache.rotate()
+        return trades
+
+    @asyncio.coroutine
+    def fetch_trades(self, url):
+        try:
+            rows, digest, gz_data, charset = yield from self.fetch_rows(url)
+        except PageNotModified:
+            if url not in self._trades:
+                raise
+            return self._trades[url], False
+
+        if url in self._trades and self._digests.get(url) == digest:
+            # Upstream does not support conditional requests, but page is the same
+            return self._trades[url], False
+
+        if self._archive is not None:
+            type_ = 1 if url == self.demands_url else 2
+            yield from self._loop.run_in_executor(
+                None, self._archive.put, self.server, type_, digest, gz_data, charset
+            )
+
+        cache = self._caches.get(url)
+        if cache is None:
+            cache = self._caches[url] = market.RowParseCache()
+
+        trades = yield from self._loop.run_in_executor(self._executor, self._collect_trades, rows, cache)
+
+        self._trades[url] = trades
+        self._digests[url] = digest
+        return trades, True
+
+    @asyncio.coroutine
+    def fetch(self):
+        # Returns (trades, delta). Trades are None when both pages are not modified since
+        # previous fetch, delta is (added, removed) against previous generation or None
+        # when there is no previous generation.
+        try:
+            (demands, demands_modified), (offers, offers_modified) = yield from asyncio.gather(
+                self.fetch_trades(self.demands_url),
+                self.fetch_trades(self.offers_url),
+                loop=self._loop,
+            )
+        except BaseException:
+            # one of pages may be remembered already, it must not be skipped as unchanged next time
+            self.reset()
+            raise
+
+        if not demands_modified and not offers_modified:
+            return None, None
+
+        trades = market.TradeList(demands=demands, offers=offers, server=self.server)
+        prev, self._prev = self._prev, trades
+
+        delta = None if prev is None else trades.diff(prev)
+        return trades, delta
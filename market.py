@@ -1,15 +1,24 @@
 # encoding: utf-8
 
 
+import os
 import re
+import sys
+import copy
+import json
+import time
+import codecs
+import hashlib
+import queue
+import calendar
 import sqlite3
 import datetime
 import itertools
+import threading
 import http.client
 import urllib.error
 import urllib.request
 
-from contextlib import closing
 from contextlib import contextmanager
 
 
@@ -27,37 +36,158 @@ class EmptyAmountError(Exception):
 
 SQLITE_DB_FILENAME = 'market_history.db'
 
+SELF_DIR = os.path.dirname(os.path.abspath(__file__))
+ITEMS_SQL_FILENAMES = (os.path.join(SELF_DIR, 'items_l2j.sql'), os.path.join(SELF_DIR, 'items_rpgclub.sql'))
+ITEMS_SNAPSHOT_FILENAME = os.path.join(SELF_DIR, 'items.json')  # parsed dumps, rebuilt when they change
+ITEM_NAMES_RELOAD_INTERVAL = 60  # seconds, cached catalog is re-read on unknown item id at most this often
+
+MARKET_URL = 'http://market.bot.rpg-club.com/%(server)s/%(side)s/price/%(order)s'
+DEFAULT_SERVER = 'motherland'
+SERVERS = (DEFAULT_SERVER,)  # rpg-club servers to watch
+
+PAGE_CHUNK_SIZE = 16 * 1024
+ROLLUP_PERIODS = (3600, 24 * 3600)  # price history bucket sizes, seconds
+HISTORY_RETENTION_MONTHS = 3  # older per-scrape rows are dropped, only rollups are kept; None keeps all
+HISTORY_TABLE_PREFIX = 'trades_'  # history is partitioned by month: trades_2015_07, ...
+UNDERCUT_PERIOD = ROLLUP_PERIODS[0]  # offer cheaper than the whole previous bucket is an undercut
+TRADER_PAGE_SIZE = 100
+SCHEMA_VERSION = 9  # version of the last migration in migrate.py this code works with
+SQLITE_READERS = 4
+SQLITE_CACHED_STATEMENTS = 256
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',  # safe with WAL, fsync only on checkpoint
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',  # 16 MB
+    'PRAGMA mmap_size = 268435456',  # 256 MB
+    'PRAGMA busy_timeout = 5000',
+)
+
 _rbulk = re.compile(r'\s\*$')
 _rtag = re.compile(r'</?\w+[^>]*>')
 
-_rrows = re.compile(r'<tr[^>]*>\s*(?:<td[^>]*>.*?</td>\s*){8}', flags=re.IGNORECASE)
 _ritems = re.compile(r'<td[^>]*>\s*(.*?)\s*</td>', flags=re.IGNORECASE)
+_rtoken = re.compile(r'<(/?)(\w+)[^>]*>|[^<]+|<')
+
+_mod_levels = {}  # mod -> level, see `mod_level`
 
 
 def tag_split(txt):
     return [x for x in _rtag.split(txt) if x]
 
 
+def trade_fingerprint(server, date, city, owner_name, item_name, item_id):
+    h = hashlib.md5()
+    h.update(server.encode())
+    h.update(str(int(date.timestamp())).encode())
+    h.update(city.encode())
+    h.update(owner_name.encode())
+    h.update(item_name.encode())
+    h.update(str(item_id).encode())
+    return h.hexdigest()
+
+
+def trade_row(type_, t):
+    # Trade as a row of history/book tables, same column order as `TradeList._stage_rows`
+    return (t.server, t.mod, t.owner_name, t.count, t.cost, t.city, t.date, type_, t.item_id, t.fingerprint)
+
+
+def mod_level(mod, _rlevel=re.compile(r'^\+?(\d+)$')):
+    # '+10' -> 10, '' -> 0. Anything else is kept as is, so it is not mixed up with a level.
+    # There are a few distinct mods, so they are parsed once.
+    level = _mod_levels.get(mod)
+    if level is None:
+        mo = _rlevel.match(mod)
+        if mo:
+            level = int(mo.group(1))
+        else:
+            level = mod or 0
+        _mod_levels[mod] = level
+    return level
+
+
+def mod_level_sql(column):
+    # SQL expression of `mod_level` for a mod column, NULL is ''
+    return '''
+        CASE
+            WHEN COALESCE(%(mod)s, '') = '' THEN 0
+            WHEN ltrim(%(mod)s, '+0123456789') = '' AND %(mod)s NOT GLOB '?*+*' AND %(mod)s != '+'
+                THEN CAST(%(mod)s AS INTEGER)
+            ELSE %(mod)s
+        END
+        ''' % {'mod': column}
+
+
+def _key_field(idx):
+    return property(lambda self: self._key[idx])
+
+
 class Trade:
-    def __init__(self, date, owner_name, city, item_name, mod, count, cost, item_id=None, bulk=False):
-        self.date = date
-        self.owner_name = owner_name
-        self.city = city
-        self._item_name = item_name
-        self.mod = mod
+    # Trade identity (everything except `count`) lives in one precomputed tuple `_key`,
+    # which is also what equality and hash are based on. Item is its integer id and mod
+    # level, names are resolved from catalog for rendering only. Repeated strings are
+    # interned, so a big history shares one copy of each owner and city.
+    __slots__ = ('_key', '_hash', '_item_name', 'mod', 'count', '_fingerprint')
+
+    server = _key_field(0)
+    date = _key_field(1)
+    owner_name = _key_field(2)
+    city = _key_field(3)
+    cost = _key_field(6)
+    bulk = _key_field(7)
+
+    def __init__(self, date, owner_name, city, item_name, mod, count, cost, item_id=None, bulk=False,
+                 server=DEFAULT_SERVER, fingerprint=None):
+        # `item_name` is None for trades loaded from db, see `item_name`
+        self._item_name = None if item_name is None else sys.intern(item_name)
+        self.mod = sys.intern(mod)
         self.count = count
-        self.cost = cost
-        self.item_id = item_id
-        self.bulk = bulk
+        self._fingerprint = fingerprint
+
+        self._key = (
+            sys.intern(server),
+            date,
+            sys.intern(owner_name),
+            sys.intern(city),
+            # page without item id still has the name to tell items apart
+            self._item_name if item_id is None else item_id,
+            mod_level(mod),
+            cost,
+            bulk,
+        )
+        self._hash = hash(self._key)
+
+    @property
+    def item_id(self):
+        item = self._key[4]
+        return item if type(item) is int else None
+
+    @property
+    def book_key(self):
+        # (server, item, mod level), only trades with the same key are matched
+        key = self._key
+        return (key[0], key[4], key[5])
 
     @property
     def item_name(self):
-        return self._item_name + self.mod
+        name = self._item_name
+        if name is None:
+            name = get_item_name(self._key[4]) or '#%s' % self._key[4]
+        return name + self.mod
+
+    @property
+    def fingerprint(self):
+        # Stable trade id for clients (ignore lists), computed once and stored with the trade
+        if self._fingerprint is None:
+            self._fingerprint = trade_fingerprint(
+                self.server, self.date, self.city, self.owner_name, self.item_name, self.item_id
+            )
+        return self._fingerprint
 
     def __repr__(self):
         return (
             'Item: {item_name}, Owner: {owner_name}, City: {city}, Date: {date}, '
-            'Count: {count}, Cost: {cost}, ID: {item_id}'.format(
+            'Count: {count}, Cost: {cost}, ID: {item_id}, Server: {server}'.format(
+                server=self.server,
                 item_name=self.item_name,
                 owner_name=self.owner_name,
                 city=self.city,
@@ -71,23 +201,10 @@ class Trade:
     def __eq__(self, other):
         if not isinstance(other, Trade):
             return False
-
-        for attr in ('date', 'owner_name', 'city', 'item_name', 'cost', 'item_id', 'bulk'):
-            if getattr(self, attr) != getattr(other, attr):
-                return False
-
-        return True
+        return self._hash == other._hash and self._key == other._key
 
     def __hash__(self):
-        return (
-            hash(self.date)
-            + hash(self.owner_name)
-            + hash(self.city)
-            + hash(self.item_name)
-            + hash(self.cost)
-            + hash(self.item_id)
-            + hash(self.bulk)
-        )
+        return self._hash
 
     @staticmethod
     def _extract_item_id(tag, _rsrc=re.compile(r'src="[^"]*?(\d+)[^"]*?"')):
@@ -109,8 +226,12 @@ class Trade:
         return None
 
     @classmethod
-    def from_table_row(cls, row):
-        date, owner_city, img_tag, item_name_en_ru, _, count, _, cost = _ritems.findall(row)
+    def from_table_row(cls, row, server=DEFAULT_SERVER):
+        return cls.from_cells(_ritems.findall(row), server=server)
+
+    @classmethod
+    def from_cells(cls, cells, server=DEFAULT_SERVER):
+        date, owner_city, img_tag, item_name_en_ru, _, count, _, cost = cells
 
         item_id = cls._extract_item_id(img_tag)
         date = cls._extract_date(date)
@@ -148,14 +269,88 @@ class Trade:
         if item_name_en.lower() == 'none' and item_name_ru:
             item_name_en = item_name_ru
 
-        return cls(date, owner_name, city, item_name_en, mod, int(count), int(cost), item_id, bulk)
+        return cls(date, owner_name, city, item_name_en, mod, int(count), int(cost), item_id, bulk, server)
+
+
+# Incremental market table parser: feed page chunks as they arrive and take complete rows
+# with `pop_rows`. Each row is a list of 8 raw cell contents, the same strings `_ritems`
+# extracts. Page is split into plain tag/text tokens, so there is nothing to backtrack over.
+class TradeRowParser:
+    cells_count = 8
+
+    def __init__(self):
+        self._tail = ''
+        self._rows = []
+        self._cells = None
+        self._cell = None
+        self._skip = False
+
+    def feed(self, data):
+        data = self._tail + data
+
+        # keep unfinished tag for the next chunk
+        tag_start = data.rfind('<')
+        if tag_start != -1 and data.find('>', tag_start) == -1:
+            data, self._tail = data[:tag_start], data[tag_start:]
+        else:
+            self._tail = ''
+
+        self._scan(data)
+
+    def close(self):
+        self._scan(self._tail)
+        self._tail = ''
+        self._end_row()
+
+    def pop_rows(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._cells.append(''.join(self._cell).replace('&nbsp;', ' ').strip())
+            self._cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        if self._cells is not None and len(self._cells) >= self.cells_count and not self._skip:
+            self._rows.append(self._cells[:self.cells_count])
+        self._cells = None
+        self._skip = False
+
+    def _scan(self, data):
+        for mo in _rtoken.finditer(data):
+            token, closing, tag = mo.group(0, 1, 2)
+            if tag is not None:
+                tag = tag.lower()
+
+            if tag == 'tr':
+                self._end_row()
+                if not closing:
+                    self._cells = []
+                    self._skip = 'list00' in token
+            elif tag == 'td' and self._cells is not None:
+                self._end_cell()
+                if not closing:
+                    self._cell = []
+                    self._skip = self._skip or 'list00' in token
+            elif tag == 'table' and closing:
+                self._end_row()
+            elif self._cell is not None:
+                self._cell.append(token)
+
+
+def get_market_urls(server=DEFAULT_SERVER):
+    return (
+        MARKET_URL % {'server': server, 'side': 'buy', 'order': 'desc'},
+        MARKET_URL % {'server': server, 'side': 'sell', 'order': 'asc'},
+    )
 
 
 class TradeList:
-    demands_url = 'http://market.bot.rpg-club.com/motherland/buy/price/desc'
-    offers_url = 'http://market.bot.rpg-club.com/motherland/sell/price/asc'
+    demands_url, offers_url = get_market_urls()
 
-    def __init__(self, demands=None, offers=None):
+    def __init__(self, demands=None, offers=None, server=None):
         if demands is None:
             demands = []
 
@@ -164,153 +359,315 @@ class TradeList:
 
         self.demands = demands
         self.offers = offers
+        # None for trades of several servers, e.g. loaded from local db
+        self.server = server
 
     @staticmethod
-    def _read_page(addr, retry=3):
+    def _open_page(addr, retry=3):
         while True:
             try:
-                resp = urllib.request.urlopen(addr, timeout=60)
+                return urllib.request.urlopen(addr, timeout=60)
             except (urllib.error.HTTPError, http.client.HTTPException) as exc:
                 if not retry:
                     raise
                 retry -= 1
                 print("Error, retry %s: %r" % (retry, exc))
-            else:
-                break
 
-        charset = resp.headers.get_content_charset('utf-8')
-        resp_str = resp.read().decode(charset)
-        resp_str = resp_str.replace('&nbsp;', ' ')
+    @classmethod
+    def _read_page(cls, addr, retry=3):
+        return ''.join(cls._iter_page(addr, retry=retry))
+
+    @classmethod
+    def _iter_page(cls, addr, retry=3):
+        resp = cls._open_page(addr, retry=retry)
+        with resp:
+            charset = resp.headers.get_content_charset('utf-8')
+            decoder = codecs.getincrementaldecoder(charset)()
+
+            while True:
+                chunk = resp.read(PAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield decoder.decode(chunk)
 
-        return resp_str
+            yield decoder.decode(b'', final=True)
 
     @staticmethod
-    def _read_trades(page):
-        trades = {}
+    def _iter_rows(chunks):
+        parser = TradeRowParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from parser.pop_rows()
 
-        for mo in _rrows.finditer(page):
-            mo_value = mo.group(0)
-            if 'list00' in mo_value:
-                continue
+        parser.close()
+        yield from parser.pop_rows()
 
-            try:
-                trade = Trade.from_table_row(mo_value)
-            except (OwnerCitySplitError, ItemNameSplitError, EmptyAmountError):
-                # Temporary errors
-                continue
-            except ValueError as exc:
-                print("Error: %r, data: %r" % (exc, mo_value))
-                continue
+    @classmethod
+    def _read_trades(cls, page, server=DEFAULT_SERVER):
+        if isinstance(page, str):
+            page = (page,)
+
+        return cls._collect_trades(cls._iter_rows(page), server=server)
+
+    @staticmethod
+    def _parse_cells(cells, server=DEFAULT_SERVER):
+        try:
+            trade = Trade.from_cells(cells, server=server)
+        except (OwnerCitySplitError, ItemNameSplitError, EmptyAmountError):
+            # Temporary errors
+            return None
+        except ValueError as exc:
+            print("Error: %r, data: %r" % (exc, cells))
+            return None
 
-            if trade.cost <= 0 or trade.count <= 0:
+        if trade.cost <= 0 or trade.count <= 0:
+            return None
+
+        return trade
+
+    @classmethod
+    def _collect_trades(cls, rows, server=DEFAULT_SERVER, cache=None):
+        trades = {}
+
+        for cells in rows:
+            if cache is not None:
+                trade = cache.parse(cells, server)
+            else:
+                trade = cls._parse_cells(cells, server)
+
+            if trade is None:
                 continue
 
-            if trade in trades:
+            existing = trades.get(trade)
+            if existing is not None:
                 # Trader sell more than one unique item
                 # Example: soul crystals, any weapon or armor, etc.
-                trades[trade].count += trade.count
+                # Parsed trades may be shared with previous page, so sum on a copy
+                existing = trades[trade] = copy.copy(existing)
+                existing.count += trade.count
             elif not trade.bulk:
                 trades[trade] = trade
 
         return list(trades.values())
 
-    def write(self, latest=False):
-        ignore_ids = []
-        new_trades = []
+    def diff(self, prev):
+        added = []
+        removed = []
 
-        with sqlite_conn() as conn:
-            cur = conn.cursor()
+        for type_, new_trades, prev_trades in ((1, self.demands, prev.demands), (2, self.offers, prev.offers)):
+            if new_trades is prev_trades:
+                # side was not modified
+                continue
 
-            # make a decision for each trade: add or ignore
-            for trades, type_ in ((self.demands, 1), (self.offers, 2)):
-                for t in trades:
-                    cur.execute(
-                        '''
-                        SELECT
-                            `id`
-                        FROM
-                            `trades`
-                        WHERE
-                            `date` = ?
-                            AND `mod` = ?
-                            AND `owner_name` = ?
-                            AND `cost` = ?
-                            AND `item_id` = ?
-                        ''',
-                        (t.date, t.mod, t.owner_name, t.cost, t.item_id)
-                    )
-
-                    res = cur.fetchone()
-                    if res:
-                        # we have this trade already, ignore
-                        ignore_ids.append(res[0])
-                        continue
-
-                    new_trades.append((
-                        t.mod,
-                        t.owner_name,
-                        t.count,
-                        t.cost,
-                        t.city,
-                        t.date,
-                        type_,
-                        latest,
-                        t.item_id,
-                    ))
-
-            if not new_trades:
-                return False
-
-            # Reset `latest` status for old trades
-            if latest:
-                expr_in = ','.join(str(i) for i in ignore_ids)
-                cur.execute(
-                    'UPDATE `trades` SET `latest` = 0 WHERE `latest` = 1 AND `id` NOT IN (%s)' % expr_in
-                )
+            prev_trades = {t: t for t in prev_trades}
+            present = set(new_trades)
 
-            # Insert new trades
-            cur.executemany(
+            for t in new_trades:
+                prev_t = prev_trades.get(t)
+                if prev_t is None:
+                    added.append((type_, t))
+                elif prev_t.count != t.count:
+                    removed.append((type_, prev_t))
+                    added.append((type_, t))
+
+            removed.extend((type_, t) for t in prev_trades if t not in present)
+
+        return added, removed
+
+    @staticmethod
+    def _stage_rows(cur, rows):
+        # `rows` are tuples of `trade_row`
+        cur.execute(
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS `scrape` (
+                `server` VARCHAR,
+                `mod` VARCHAR,
+                `owner_name`    VARCHAR,
+                `count` INTEGER,
+                `cost`  INTEGER,
+                `city`  VARCHAR,
+                `date`  DATETIME,
+                `type`  INTEGER,
+                `item_id` INTEGER,
+                `fingerprint`   VARCHAR
+            )
+            '''
+        )
+        cur.execute('DELETE FROM temp.`scrape`')
+        cur.executemany('INSERT INTO temp.`scrape` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    @classmethod
+    def _stage(cls, cur, trades):
+        cls._stage_rows(cur, (trade_row(type_, t) for type_, t in trades))
+
+    @staticmethod
+    def _insert_staged(cur, first_month=None):
+        # Staged rows go to history partition of their month, rows older than retention are not kept.
+        # Rollups and owners are kept up to date once their migrations have created them, older
+        # rows are filled by the migrations themselves, see migrate.py.
+        if first_month is None:
+            first_month = history_start(HISTORY_RETENTION_MONTHS)
+        months = [
+            row[0] for row in cur.execute("SELECT DISTINCT strftime('%Y_%m', `date`) FROM temp.`scrape`").fetchall()
+        ]
+        # checked inside the write transaction, which is already open for staged rows
+        with_rollups = table_exists(cur, 'rollups')
+        with_owners = table_exists(cur, 'owners')
+
+        owner_column = owner_value = owner_join = ''
+        if with_owners:
+            cur.execute(
+                'INSERT OR IGNORE INTO `owners` (`server`, `name`) SELECT DISTINCT `server`, `owner_name` FROM temp.`scrape`'
+            )
+            owner_column = ', `owner_id`'
+            owner_value = ', `owners`.`id`'
+            owner_join = 'INNER JOIN `owners` ON `owners`.`server` = `scrape`.`server` AND `owners`.`name` = `owner_name`'
+
+        inserted = 0
+        for month in months:
+            if month is None or month < first_month:
+                continue
+
+            table = history_table(month)
+            create_history_table(cur, table)
+            last_id = cur.execute('SELECT MAX(`id`) FROM `%s`' % table).fetchone()[0] or 0
+            cur.execute(
                 '''
-                INSERT INTO trades (
-                    `mod`, `owner_name`, `count`, `cost`, `city`, `date`, `type`, `latest`, `item_id`
-                ) VALUES (
-                    ?, ?, ?, ?, ?, ?, ?, ?, ?
+                INSERT OR IGNORE INTO `%s` (
+                    `server`, `mod`, `owner_name`, `count`, `cost`, `city`, `date`, `type`, `item_id`, `fingerprint`%s
                 )
-                ''',
-                new_trades
+                SELECT
+                    `scrape`.`server`, `mod`, `owner_name`, `count`, `cost`, `city`, `date`, `type`, `item_id`,
+                    `fingerprint`%s
+                FROM
+                    temp.`scrape`
+                    %s
+                WHERE
+                    strftime('%%Y_%%m', `date`) = ?
+                ''' % (table, owner_column, owner_value, owner_join),
+                (month,)
             )
 
-        return len(new_trades) != 0
+            if cur.rowcount > 0:
+                inserted += cur.rowcount
+                if with_rollups:
+                    update_rollups(cur, table, last_id)
+                if with_owners:
+                    update_owners(cur, table, last_id)
 
-    @classmethod
-    def from_local(cls, latest_only=True):
-        q = '''
+        return inserted
+
+    @staticmethod
+    def _insert_book(cur):
+        cur.execute(
+            '''
+            INSERT OR IGNORE INTO `book` (
+                `server`, `mod`, `owner_name`, `count`, `cost`, `city`, `date`, `type`, `item_id`, `fingerprint`
+            )
             SELECT
-                `items`.`name`,
-                `mod`,
-                `owner_name`,
-                `count`,
-                `cost`,
-                `city`,
-                `type`,
-                `date` as "[timestamp]",
-                `item_id`
+                `server`, `mod`, `owner_name`, `count`, `cost`, `city`, `date`, `type`, `item_id`, `fingerprint`
             FROM
-                `trades`
-                INNER JOIN `items` ON `trades`.`item_id` = `items`.`id`
+                temp.`scrape`
             '''
-        if latest_only:
-            q += ' WHERE `latest` = 1'
+        )
 
+    @staticmethod
+    def _stage_ids(cur):
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS `scrape_ids` (`id` INTEGER PRIMARY KEY)')
+        cur.execute('DELETE FROM temp.`scrape_ids`')
+        cur.execute(
+            '''
+            INSERT OR IGNORE INTO temp.`scrape_ids`
+            SELECT
+                `book`.`id`
+            FROM
+                temp.`scrape`
+                INNER JOIN `book` ON
+                    `book`.`server` = `scrape`.`server`
+                    -- unknown item or unparsed date is NULL, it must match as well
+                    AND `book`.`date` IS `scrape`.`date`
+                    AND `book`.`owner_name` IS `scrape`.`owner_name`
+                    AND `book`.`mod` IS `scrape`.`mod`
+                    AND `book`.`cost` IS `scrape`.`cost`
+                    AND `book`.`item_id` IS `scrape`.`item_id`
+            '''
+        )
+
+    def _typed(self):
+        for trades, type_ in ((self.demands, 1), (self.offers, 2)):
+            for t in trades:
+                yield type_, t
+
+    def write(self, latest=False):
+        with sqlite_conn() as conn:
+            cur = conn.cursor()
+
+            # Stage whole scrape at once, then let `iTrade` index decide what is new
+            self._stage(cur, self._typed())
+            inserted = self._insert_staged(cur)
+
+            if latest:
+                if self.server is not None:
+                    servers = [self.server]
+                else:
+                    servers = [row[0] for row in cur.execute('SELECT DISTINCT `server` FROM temp.`scrape`')]
+
+                # Current book of scraped servers is exactly the set of scraped rows
+                cur.execute('DELETE FROM `book` WHERE `server` IN (%s)' % ','.join('?' * len(servers)), servers)
+                self._insert_book(cur)
+
+        return inserted != 0
+
+    @classmethod
+    def write_delta(cls, added, removed):
+        # Apply difference between two generations of latest trades, see `diff`
         with sqlite_conn() as conn:
             cur = conn.cursor()
-            cur.execute(q)
+
+            # Removed first: trade with changed count is removed and added with the same key
+            if removed:
+                cls._stage(cur, removed)
+                cls._stage_ids(cur)
+                cur.execute('DELETE FROM `book` WHERE `id` IN temp.`scrape_ids`')
+
+            inserted = 0
+            if added:
+                cls._stage(cur, added)
+                inserted = cls._insert_staged(cur)
+                cls._insert_book(cur)
+
+        return inserted != 0
+
+    @classmethod
+    def from_local(cls, latest_only=True, server=None):
+        columns = '''
+            `server`,
+            `item_id`,
+            `mod`,
+            `owner_name`,
+            `count`,
+            `cost`,
+            `city`,
+            `type`,
+            `date` as "[timestamp]",
+            `fingerprint`
+            '''
+
+        with sqlite_conn(readonly=True) as conn:
+            cur = select_trades(conn.cursor(), columns, latest_only=latest_only, server=server)
 
             demands = []
             offers = []
             for row in cur:
-                item_name, mod, owner_name, count, cost, city, type_, date, item_id = row
-                trade = Trade(date, owner_name, city, item_name, mod or '', count, cost, item_id=item_id)
+                server_, item_id, mod, owner_name, count, cost, city, type_, date, fingerprint = row
+                if item_id is None:
+                    continue  # name is not stored, so such item can not be told apart
+
+                # items missing from catalog are kept, names are resolved on rendering
+                trade = Trade(
+                    date, owner_name, city, None, mod or '', count, cost, item_id=item_id, server=server_,
+                    fingerprint=fingerprint,
+                )
 
                 if type_ == 1:
                     demands.append(trade)
@@ -319,70 +676,971 @@ class TradeList:
                 else:
                     raise NotImplementedError
 
-        return cls(demands=demands, offers=offers)
+        return cls(demands=demands, offers=offers, server=server)
 
 
     @classmethod
-    def from_remote(cls):
-        demands = cls._read_trades(cls._read_page(cls.demands_url))
-        offers = cls._read_trades(cls._read_page(cls.offers_url))
-        return cls(demands=demands, offers=offers)
+    def from_remote(cls, server=DEFAULT_SERVER):
+        demands_url, offers_url = get_market_urls(server)
+        demands = cls._read_trades(cls._iter_page(demands_url), server=server)
+        offers = cls._read_trades(cls._iter_page(offers_url), server=server)
+        return cls(demands=demands, offers=offers, server=server)
 
 
-def get_trades(remote=False):
-    if remote:
-        return TradeList.from_remote()
-    return TradeList.from_local()
+class RowParseCache:
+    # Trades parsed from rows of the previous page, unchanged rows are not parsed again
 
+    def __init__(self):
+        self._prev = {}
+        self._next = {}
 
-@contextmanager
-def sqlite_conn(filename=SQLITE_DB_FILENAME, autocommit=True):
-    with closing(sqlite3.connect(
-        filename, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-    ) as conn:
-        yield conn
-        if autocommit:
-            conn.commit()
+    def parse(self, cells, server=DEFAULT_SERVER):
+        key = tuple(cells)
+        try:
+            trade = self._next[key]
+        except KeyError:
+            trade = self._prev[key] if key in self._prev else TradeList._parse_cells(cells, server)
+            self._next[key] = trade
+        return trade
+
+    def rotate(self):
+        self._prev, self._next = self._next, {}
+
+    def clear(self):
+        self._prev.clear()
+        self._next.clear()
+
+
+def _bucket_start(date, period):
+    ts = calendar.timegm(date.timetuple())
+    return ts - ts % period
+
+
+def _lower_median(cost_trades, trades):
+    # `cost_trades` are (cost, trades with this cost) pairs ordered by cost
+    idx = (trades - 1) // 2
+    for cost, n in cost_trades:
+        idx -= n
+        if idx < 0:
+            return cost
+    return None
+
+
+def update_rollups(cur, table, since_id, until_id=None, periods=ROLLUP_PERIODS):
+    # Add trades of `table` with `since_id` < id <= `until_id` to price buckets of every period.
+    # Work is proportional to new trades and buckets they fall in, not to the history.
+    q = '''
+        SELECT `server`, `item_id`, COALESCE(`mod`, ''), `type`, `date` as "[timestamp]", `cost`, `count`
+        FROM `%s`
+        WHERE `id` > ? AND `item_id` IS NOT NULL
+        ''' % table
+    params = [since_id]
+    if until_id is not None:
+        q += ' AND `id` <= ?'
+        params.append(until_id)
+    q += ' ORDER BY `date`, `id`'
+
+    # (server, item_id, period, type, mod, bucket) -> [open, high, low, close, volume, trades, open_date, close_date]
+    buckets = {}
+    costs = {}  # bucket key -> cost -> trades
+    for server, item_id, mod, type_, date, cost, count in cur.execute(q, params).fetchall():
+        for period in periods:
+            key = (server, item_id, period, type_, mod_level(mod), _bucket_start(date, period))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [cost, cost, cost, cost, count, 1, date, date]
+            else:
+                bucket[1] = max(bucket[1], cost)
+                bucket[2] = min(bucket[2], cost)
+                bucket[3] = cost
+                bucket[4] += count
+                bucket[5] += 1
+                bucket[7] = date
+
+            bucket_costs = costs.get(key)
+            if bucket_costs is None:
+                bucket_costs = costs[key] = {}
+            bucket_costs[cost] = bucket_costs.get(cost, 0) + 1
+
+    if not buckets:
+        return
+
+    # Existing buckets are fetched at once, new ones do not need any lookups
+    cur.execute(
+        '''
+        CREATE TEMP TABLE IF NOT EXISTS `rollup_keys` (
+            `server` VARCHAR, `item_id` INTEGER, `period` INTEGER, `type` INTEGER, `mod` INTEGER, `bucket` INTEGER
+        )
+        '''
+    )
+    cur.execute('DELETE FROM temp.`rollup_keys`')
+    cur.executemany('INSERT INTO temp.`rollup_keys` VALUES (?, ?, ?, ?, ?, ?)', buckets)
+    existing = {
+        tuple(row[:6]): row[6:]
+        for row in cur.execute(
+            '''
+            SELECT
+                `rollups`.`server`, `rollups`.`item_id`, `rollups`.`period`,
+                `rollups`.`type`, `rollups`.`mod`, `rollups`.`bucket`,
+                `open`, `high`, `low`, `close`, `volume`, `trades`,
+                `open_date` as "[timestamp]", `close_date` as "[timestamp]"
+            FROM
+                temp.`rollup_keys`
+                INNER JOIN `rollups` USING (`server`, `item_id`, `period`, `type`, `mod`, `bucket`)
+            '''
+        )
+    }
+
+    cur.executemany(
+        '''
+        INSERT OR IGNORE INTO `rollup_costs` (`server`, `item_id`, `period`, `type`, `mod`, `bucket`, `cost`, `trades`)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+        ''',
+        (key + (cost,) for key, bucket_costs in costs.items() if key in existing for cost in bucket_costs)
+    )
+    cur.executemany(
+        '''
+        UPDATE `rollup_costs` SET `trades` = `trades` + ?
+        WHERE `server` = ? AND `item_id` = ? AND `period` = ? AND `type` = ? AND `mod` = ? AND `bucket` = ? AND `cost` = ?
+        ''',
+        (
+            (trades,) + key + (cost,)
+            for key, bucket_costs in costs.items() if key in existing
+            for cost, trades in bucket_costs.items()
+        )
+    )
+    cur.executemany(
+        '''
+        INSERT INTO `rollup_costs` (`server`, `item_id`, `period`, `type`, `mod`, `bucket`, `cost`, `trades`)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''',
+        (
+            key + (cost, trades)
+            for key, bucket_costs in costs.items() if key not in existing
+            for cost, trades in bucket_costs.items()
+        )
+    )
+
+    rollups = []
+    for key, (open_, high, low, close, volume, trades, open_date, close_date) in buckets.items():
+        prev = existing.get(key)
+        if prev is None:
+            median = _lower_median(sorted(costs[key].items()), trades)
+        else:
+            prev_open, prev_high, prev_low, prev_close, prev_volume, prev_trades, prev_open_date, prev_close_date = prev
+            # trades of old scrapes may be posted later than the new ones
+            if prev_open_date <= open_date:
+                open_, open_date = prev_open, prev_open_date
+            if prev_close_date > close_date:
+                close, close_date = prev_close, prev_close_date
+            high = max(high, prev_high)
+            low = min(low, prev_low)
+            volume += prev_volume
+            trades += prev_trades
+
+            median = _lower_median(
+                cur.execute(
+                    '''
+                    SELECT `cost`, `trades` FROM `rollup_costs`
+                    WHERE `server` = ? AND `item_id` = ? AND `period` = ? AND `type` = ? AND `mod` = ? AND `bucket` = ?
+                    ORDER BY `cost`
+                    ''',
+                    key
+                ),
+                trades
+            )
 
+        rollups.append(key + (open_, high, low, close, median, volume, trades, open_date, close_date))
 
-def sqlite_init_items(filename=SQLITE_DB_FILENAME):
-    with sqlite_conn(filename=filename) as conn:
+    cur.executemany(
+        '''
+        INSERT OR REPLACE INTO `rollups` (
+            `server`, `item_id`, `period`, `type`, `mod`, `bucket`,
+            `open`, `high`, `low`, `close`, `median`, `volume`, `trades`, `open_date`, `close_date`
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''',
+        rollups
+    )
+
+
+def get_history(item_id, server=DEFAULT_SERVER, period=ROLLUP_PERIODS[0], type_=None, mod=None,
+                since=None, until=None):
+    # Price buckets of one item, `since` and `until` are unix timestamps, `mod` is a level, see `mod_level`
+    q = '''
+        SELECT
+            `type`, `mod`, `bucket`, `open`, `high`, `low`, `close`, `median`, `volume`, `trades`
+        FROM `rollups`
+        WHERE `server` = ? AND `item_id` = ? AND `period` = ?
+        '''
+    params = [server, item_id, period]
+    if type_ is not None:
+        q += ' AND `type` = ?'
+        params.append(type_)
+    if mod is not None:
+        q += ' AND `mod` = ?'
+        params.append(mod)
+    if since is not None:
+        q += ' AND `bucket` >= ?'
+        params.append(since - since % period)
+    if until is not None:
+        q += ' AND `bucket` <= ?'
+        params.append(until)
+    q += ' ORDER BY `bucket`, `type`, `mod`'
+
+    with sqlite_conn(readonly=True) as conn:
+        return [
+            {
+                'type': type_,
+                'mod': mod,
+                'time': bucket,
+                'open': open_,
+                'high': high,
+                'low': low,
+                'close': close,
+                'median': median,
+                'volume': volume,
+                'trades': trades,
+            }
+            for type_, mod, bucket, open_, high, low, close, median, volume, trades in conn.execute(q, params)
+        ]
+
+
+def update_owners(cur, table, since_id, until_id=None, undercut_period=UNDERCUT_PERIOD):
+    # Add trades of `table` with `since_id` < id <= `until_id` to owner totals. Offer is an
+    # undercut, when it is cheaper than any offer of the item during the previous rollup bucket.
+    q = '''
+        SELECT
+            `t`.`owner_id`,
+            MIN(`t`.`date`),
+            MAX(`t`.`date`),
+            SUM(`t`.`type` = 1),
+            SUM(`t`.`type` = 2),
+            SUM(CASE WHEN `t`.`type` = 1 THEN `t`.`count` * `t`.`cost` ELSE 0 END),
+            SUM(CASE WHEN `t`.`type` = 2 THEN `t`.`count` * `t`.`cost` ELSE 0 END),
+            SUM(`t`.`type` = 2 AND `t`.`cost` < `rollups`.`low`)
+        FROM
+            `%s` AS `t`
+            LEFT JOIN `rollups` ON
+                `rollups`.`server` = `t`.`server`
+                AND `rollups`.`item_id` = `t`.`item_id`
+                AND `rollups`.`period` = ?
+                AND `rollups`.`type` = 2
+                AND `rollups`.`mod` = %s
+                AND `rollups`.`bucket` = (CAST(strftime('%%s', `t`.`date`) AS INTEGER) / ? - 1) * ?
+        WHERE `t`.`id` > ? AND `t`.`owner_id` IS NOT NULL
+        ''' % (table, mod_level_sql('`t`.`mod`'))
+    params = [undercut_period, undercut_period, undercut_period, since_id]
+    if until_id is not None:
+        q += ' AND `t`.`id` <= ?'
+        params.append(until_id)
+    q += ' GROUP BY `t`.`owner_id`'
+
+    totals = cur.execute(q, params).fetchall()
+    cur.executemany(
+        '''
+        UPDATE `owners` SET
+            `first_date` = min(COALESCE(`first_date`, ?2), ?2),
+            `last_date` = max(COALESCE(`last_date`, ?3), ?3),
+            `demands` = `demands` + ?4,
+            `offers` = `offers` + ?5,
+            `demand_volume` = `demand_volume` + ?6,
+            `offer_volume` = `offer_volume` + ?7,
+            `undercuts` = `undercuts` + COALESCE(?8, 0)
+        WHERE `id` = ?1
+        ''',
+        totals
+    )
+    return len(totals)
+
+
+def _trader_cursor(date, id_):
+    return '%d:%d' % (calendar.timegm(date.timetuple()), id_)
+
+
+def get_trader(name, server=DEFAULT_SERVER, limit=TRADER_PAGE_SIZE, cursor=None):
+    # Totals of one trader and a page of their listings, newest first. Listings come from
+    # history tables through `iOwner_*` indexes, totals are kept for compacted months too.
+    # Returns None for unknown trader, raises ValueError for malformed cursor.
+    after = None
+    if cursor is not None:
+        ts, _, id_ = cursor.partition(':')
+        if not ts.isdigit() or not id_.isdigit():
+            raise ValueError('Invalid cursor: %r' % cursor)
+        after = (datetime.datetime.utcfromtimestamp(int(ts)), int(id_))
+
+    with sqlite_conn(readonly=True) as conn:
         cur = conn.cursor()
-        cur.execute(
+        owner = cur.execute(
             '''
-            CREATE TABLE "items" (
-                `id`    INTEGER NOT NULL PRIMARY KEY,
-                `name`  VARCHAR
-            )
+            SELECT
+                `id`, `first_date` as "[timestamp]", `last_date` as "[timestamp]", `demands`, `offers`,
+                `demand_volume`, `offer_volume`, `undercuts`
+            FROM `owners`
+            WHERE `server` = ? AND `name` = ?
+            ''',
+            (server, name)
+        ).fetchone()
+        if owner is None:
+            return None
+
+        owner_id, first_date, last_date, demands, offers, demand_volume, offer_volume, undercuts = owner
+
+        rows = []
+        tables = history_tables(cur)
+        for table in reversed(tables):
+            q = '''
+                SELECT `id`, `date` as "[timestamp]", `type`, `item_id`, `mod`, `count`, `cost`, `city`
+                FROM `%s`
+                WHERE `owner_id` = ?
+                ''' % table
+            params = [owner_id]
+            if after is not None:
+                after_table = history_table(after[0].strftime('%Y_%m'))
+                if table > after_table:
+                    continue
+                if table == after_table:
+                    q += ' AND (`date` < ? OR (`date` = ? AND `id` < ?))'
+                    params.extend((after[0], after[0], after[1]))
+            q += ' ORDER BY `date` DESC, `id` DESC LIMIT ?'
+            params.append(limit + 1 - len(rows))
+
+            rows.extend(cur.execute(q, params))
+            if len(rows) > limit:
+                break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _trader_cursor(rows[-1][1], rows[-1][0])
+
+    return {
+        'server': server,
+        'name': name,
+        'first_date': None if first_date is None else int(first_date.timestamp()),
+        'last_date': None if last_date is None else int(last_date.timestamp()),
+        'demands': demands,
+        'offers': offers,
+        'demand_volume': demand_volume,
+        'offer_volume': offer_volume,
+        'undercuts': undercuts,
+        'listings': [
+            {
+                'type': type_,
+                'item_id': item_id,
+                'item_name': (get_item_name(item_id) or '#%s' % item_id) + (mod or ''),
+                'mod': mod_level(mod or ''),
+                'count': count,
+                'cost': cost,
+                'city': city,
+                'date': int(date.timestamp()),
+            }
+            for _, date, type_, item_id, mod, count, cost, city in rows
+        ],
+        'next': next_cursor,
+    }
+
+
+def _alert_row(row):
+    id_, token, server, items, cities, min_equity, max_required_aden = row
+    return {
+        'id': id_,
+        'token': token,
+        'server': server,
+        'items': [int(item_id) for item_id in items.split(',') if item_id],
+        'cities': [city for city in cities.split(',') if city],
+        'min_equity': min_equity,
+        'max_required_aden': max_required_aden,
+    }
+
+
+def get_alerts(token=None):
+    # Alert subscriptions of one subscriber, or all of them when `token` is None
+    q = 'SELECT `id`, `token`, `server`, `items`, `cities`, `min_equity`, `max_required_aden` FROM `alerts`'
+    args = ()
+    if token is not None:
+        q += ' WHERE `token` = ?'
+        args = (token,)
+
+    with sqlite_conn(readonly=True) as conn:
+        return [_alert_row(row) for row in conn.cursor().execute(q + ' ORDER BY `id`', args)]
+
+
+def add_alert(token, server=None, items=(), cities=(), min_equity=None, max_required_aden=None):
+    # Empty `items` or `cities` and None `server` match any, cities are names in lower case
+    row = [
+        token,
+        server,
+        ','.join(str(item_id) for item_id in sorted(set(items))),
+        ','.join(sorted(set(cities))),
+        min_equity,
+        max_required_aden,
+    ]
+    with sqlite_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
             '''
+            INSERT INTO `alerts` (`token`, `server`, `items`, `cities`, `min_equity`, `max_required_aden`, `created`)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            row + [datetime.datetime.now()]
         )
-        cur.execute('CREATE UNIQUE INDEX iID ON `items` (`id`)')
+        return _alert_row([cur.lastrowid] + row)
 
 
-def sqlite_init_trades(filename=SQLITE_DB_FILENAME):
+def delete_alert(token, alert_id):
+    # Returns False when subscriber has no such alert
+    with sqlite_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM `alerts` WHERE `id` = ? AND `token` = ?', (alert_id, token))
+        return cur.rowcount > 0
+
+
+def history_table(month):
+    # `month` is 'YYYY_MM'
+    return HISTORY_TABLE_PREFIX + month
+
+
+def history_tables(cur):
+    return [
+        row[0] for row in cur.execute(
+            "SELECT `name` FROM `sqlite_master` WHERE `type` = 'table' AND `name` GLOB ? ORDER BY `name`",
+            (HISTORY_TABLE_PREFIX + '[0-9][0-9][0-9][0-9]_[0-9][0-9]',)
+        )
+    ]
+
+
+def history_start(months=HISTORY_RETENTION_MONTHS, now=None):
+    # First month of kept history, 'YYYY_MM'. Compares as string with months of history tables.
+    if months is None:
+        return ''
+    if now is None:
+        now = datetime.datetime.now()
+    year, month = divmod(now.year * 12 + now.month - 1 - months, 12)
+    return '%04d_%02d' % (year, month + 1)
+
+
+def table_exists(cur, table):
+    row = cur.execute("SELECT 1 FROM `sqlite_master` WHERE `type` = 'table' AND `name` = ?", (table,)).fetchone()
+    return row is not None
+
+
+def create_history_table(cur, table):
+    # Indexes of existing month tables are left to migrations, crawler must not build them
+    if table_exists(cur, table):
+        return
+
+    cur.execute(
+        '''
+        CREATE TABLE `%(table)s` (
+            `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            `server`    VARCHAR NOT NULL DEFAULT 'motherland',
+            `mod` VARCHAR,
+            `owner_name`    VARCHAR,
+            `count` INTEGER CHECK (`count` > 0),
+            `cost`  INTEGER CHECK (`cost` > 0),
+            `city`  VARCHAR,
+            `type`  INTEGER CHECK (`type` IN (1, 2)),  -- 1 demand (buy), 2 -- offer (sell)
+            `date`  DATETIME,
+            `item_id` INTEGER,
+            `fingerprint`   VARCHAR,
+            `owner_id`  INTEGER,
+            FOREIGN KEY(`item_id`) REFERENCES "items"(`id`),
+            FOREIGN KEY(`owner_id`) REFERENCES "owners"(`id`)
+        )
+        ''' % {'table': table}
+    )
+    create_history_indexes(cur, table)
+
+
+def create_history_indexes(cur, table):
+    cur.execute(
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS `iTrade_%(table)s`
+        ON `%(table)s` (`server`, `date`, `owner_name`, `mod`, `cost`, `item_id`)
+        ''' % {'table': table}
+    )
+    cur.execute('CREATE INDEX IF NOT EXISTS `iFingerprint_%(table)s` ON `%(table)s` (`fingerprint`)' % {'table': table})
+    # covering: trader listings and item prices are read from index only, see `get_trader`
+    cur.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS `iOwner_%(table)s`
+        ON `%(table)s` (`owner_id`, `date`, `id`, `type`, `item_id`, `mod`, `count`, `cost`, `city`)
+        ''' % {'table': table}
+    )
+    cur.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS `iItem_%(table)s`
+        ON `%(table)s` (`item_id`, `type`, `date`, `mod`, `cost`, `count`)
+        ''' % {'table': table}
+    )
+
+
+def select_trades(cur, columns, latest_only=True, server=None):
+    # Rows of the current book or of the whole history. Item names are not joined,
+    # they are taken from `get_item_name()` when rendered.
+    tables = ['book'] if latest_only else history_tables(cur)
+    if not tables:
+        return iter(())
+
+    parts = []
+    params = []
+    for table in tables:
+        q = 'SELECT %s FROM `%s`' % (columns, table)
+        if server is not None:
+            q += ' WHERE `server` = ?'
+            params.append(server)
+        parts.append(q)
+
+    return cur.execute(' UNION ALL '.join(parts), params)
+
+
+def compact_history(months=HISTORY_RETENTION_MONTHS, now=None, filename=SQLITE_DB_FILENAME):
+    # Per-scrape rows of months older than retention are dropped, their prices stay in daily
+    # rollups. Hourly buckets and median histograms of those months are collapsed as well.
+    # New rows are never written there again, see `TradeList._insert_staged`.
+    if months is None:
+        return []
+
+    first_month = history_start(months, now)
+    year, month = (int(x) for x in first_month.split('_'))
+    cutoff = calendar.timegm((year, month, 1, 0, 0, 0))
+
     with sqlite_conn(filename=filename) as conn:
         cur = conn.cursor()
-        cur.execute(
-            '''
-            CREATE TABLE "trades" (
-                `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-                `item_name` VARCHAR,
-                `mod` VARCHAR,
-                `owner_name`    VARCHAR,
-                `count` INTEGER CHECK (`count` > 0),
-                `cost`  INTEGER CHECK (`cost` > 0),
-                `city`  VARCHAR,
-                `type`  INTEGER CHECK (`type` IN (1, 2)),  -- 1 demand (buy), 2 -- offer (sell)
-                `date`  DATETIME,
-                `latest`    BOOLEAN DEFAULT 0,
-                `item_id` INTEGER,
-                FOREIGN KEY(`item_id`) REFERENCES "items"(`id`)
+
+        # pending migrations still have to fill rollups and owners from these rows
+        version = schema_version(cur)
+        if version < SCHEMA_VERSION:
+            raise RuntimeError(
+                'Database schema is at version %d of %d, run migrate.py before compaction' % (version, SCHEMA_VERSION)
             )
-            '''
+
+        dropped = [table for table in history_tables(cur) if table[len(HISTORY_TABLE_PREFIX):] < first_month]
+        for table in dropped:
+            cur.execute('DROP TABLE `%s`' % table)
+
+        cur.execute('DELETE FROM `rollups` WHERE `period` < ? AND `bucket` < ?', (max(ROLLUP_PERIODS), cutoff))
+        cur.execute('DELETE FROM `rollup_costs` WHERE `bucket` < ?', (cutoff,))
+
+    return dropped
+
+
+def schema_version(cur):
+    # Last applied migration, they are applied in order, see migrate.py
+    if not cur.execute("SELECT 1 FROM `sqlite_master` WHERE `type` = 'table' AND `name` = 'schema_migrations'").fetchone():
+        return 0
+    return cur.execute('SELECT MAX(`version`) FROM `schema_migrations` WHERE `applied` IS NOT NULL').fetchone()[0] or 0
+
+
+def get_schema_version(filename=SQLITE_DB_FILENAME):
+    with sqlite_conn(filename=filename, readonly=True) as conn:
+        return schema_version(conn.cursor())
+
+
+def get_trades(remote=False, server=None):
+    if remote:
+        return TradeList.from_remote(server=server or DEFAULT_SERVER)
+    return TradeList.from_local(server=server)
+
+
+class ConnectionManager:
+    def __init__(self, filename, readers=SQLITE_READERS):
+        self.filename = filename
+        self.readers = readers
+
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._pool = queue.LifoQueue()
+        self._opened = 0
+        self._opened_lock = threading.Lock()
+
+        self._item_names = None
+        self._item_names_loaded = None  # time.monotonic() of the last read
+        self._item_names_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.filename,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+        )
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @staticmethod
+    def _enable_wal(conn):
+        # Readers work on their own snapshot and never wait for writer commit. Journal mode
+        # is stored in the database file, so it is switched only once for a new database.
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            conn.execute('PRAGMA journal_mode = WAL')
+
+    def _get_writer(self):
+        if self._writer is None:
+            conn = self._connect()
+            self._enable_wal(conn)
+            self._writer = conn
+        return self._writer
+
+    @contextmanager
+    def writer(self, autocommit=True):
+        with self._writer_lock:
+            conn = self._get_writer()
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+
+            if autocommit:
+                conn.commit()
+            else:
+                conn.rollback()
+
+    def _acquire_reader(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._opened_lock:
+            can_open = self._opened < self.readers
+            if can_open:
+                self._opened += 1
+
+        if not can_open:
+            return self._pool.get()
+
+        # journal mode is checked by the reader itself, it must not wait for writer lock
+        conn = self._connect()
+        self._enable_wal(conn)
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    @contextmanager
+    def reader(self):
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            self._pool.put(conn)
+
+    def item_names(self, reload=False):
+        # item_id -> name, cached: catalog is changed by `load_items`, maybe of another process
+        names = self._item_names
+        if names is None or reload:
+            with self._item_names_lock:
+                if self._item_names is None or self._item_names is names:
+                    with self.reader() as conn:
+                        self._item_names = dict(conn.execute('SELECT `id`, `name` FROM `items`'))
+                    self._item_names_loaded = time.monotonic()
+                names = self._item_names
+        return names
+
+    def item_name(self, item_id):
+        # Unknown id may be loaded after names are cached, catalog is re-read then, but not on every miss
+        name = self.item_names().get(item_id)
+        if name is None and time.monotonic() - self._item_names_loaded >= ITEM_NAMES_RELOAD_INTERVAL:
+            name = self.item_names(reload=True).get(item_id)
+        return name
+
+    def forget_item_names(self):
+        self._item_names = None
+
+    def close(self):
+        self.forget_item_names()
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+            with self._opened_lock:
+                self._opened -= 1
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_db(filename=SQLITE_DB_FILENAME):
+    with _managers_lock:
+        manager = _managers.get(filename)
+        if manager is None:
+            manager = _managers[filename] = ConnectionManager(filename)
+        return manager
+
+
+def close_db():
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+
+    for manager in managers:
+        manager.close()
+
+
+def sqlite_conn(filename=SQLITE_DB_FILENAME, autocommit=True, readonly=False):
+    db = get_db(filename)
+    if readonly:
+        return db.reader()
+    return db.writer(autocommit=autocommit)
+
+
+def get_item_names(filename=SQLITE_DB_FILENAME):
+    return get_db(filename).item_names()
+
+
+def get_item_name(item_id, filename=SQLITE_DB_FILENAME):
+    return get_db(filename).item_name(item_id)
+
+
+def parse_items_sql(text, _rinsert=re.compile(
+    r"INSERT\s+INTO\s+`?items`?\s*\(\s*`?id`?\s*,\s*`?name`?\s*\)\s*"
+    r"VALUES\s*\(\s*(\d+)\s*,\s*'((?:[^']|'')*)'\s*\)",
+    flags=re.IGNORECASE
+)):
+    # Statements are matched, not split by ';', which may be a part of quoted name
+    return [(int(item_id), name.replace("''", "'")) for item_id, name in _rinsert.findall(text)]
+
+
+def read_items_snapshot(sql_filenames=ITEMS_SQL_FILENAMES, snapshot_filename=ITEMS_SNAPSHOT_FILENAME):
+    try:
+        snapshot_mtime = os.path.getmtime(snapshot_filename)
+    except OSError:
+        snapshot_mtime = None
+
+    if snapshot_mtime is not None and all(os.path.getmtime(fn) <= snapshot_mtime for fn in sql_filenames):
+        with open(snapshot_filename, encoding='utf-8') as f:
+            return [tuple(item) for item in json.load(f)]
+
+    items = []
+    for fn in sql_filenames:
+        with open(fn, encoding='utf-8') as f:
+            items.extend(parse_items_sql(f.read()))
+
+    try:
+        with open(snapshot_filename, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False, separators=(',', ':'))
+    except OSError as exc:
+        print("Items snapshot is not saved: %r" % exc)
+
+    return items
+
+
+def load_items(filename=SQLITE_DB_FILENAME, sql_filenames=ITEMS_SQL_FILENAMES,
+               snapshot_filename=ITEMS_SNAPSHOT_FILENAME):
+    # Whole catalog in one transaction, later dumps override names of earlier ones
+    items = read_items_snapshot(sql_filenames, snapshot_filename)
+
+    db = get_db(filename)
+    with db.writer() as conn:
+        conn.executemany('INSERT OR REPLACE INTO `items` (`id`, `name`) VALUES (?, ?)', items)
+    db.forget_item_names()
+
+    return len(items)
+
+
+def create_items_table(cur):
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "items" (
+            `id`    INTEGER NOT NULL PRIMARY KEY,
+            `name`  VARCHAR
+        )
+        '''
+    )
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS iID ON `items` (`id`)')
+
+
+def sqlite_init_items(filename=SQLITE_DB_FILENAME):
+    with sqlite_conn(filename=filename) as conn:
+        create_items_table(conn.cursor())
+
+
+def create_book_table(cur):
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "book" (
+            `id`    INTEGER NOT NULL PRIMARY KEY,
+            `server`    VARCHAR NOT NULL DEFAULT 'motherland',
+            `mod` VARCHAR,
+            `owner_name`    VARCHAR,
+            `count` INTEGER CHECK (`count` > 0),
+            `cost`  INTEGER CHECK (`cost` > 0),
+            `city`  VARCHAR,
+            `type`  INTEGER CHECK (`type` IN (1, 2)),  -- 1 demand (buy), 2 -- offer (sell)
+            `date`  DATETIME,
+            `item_id` INTEGER,
+            `fingerprint`   VARCHAR,
+            FOREIGN KEY(`item_id`) REFERENCES "items"(`id`)
+        )
+        '''
+    )
+    # Current book only, history goes to monthly tables created on write, see `create_history_table`
+    cur.execute(
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS iBook
+        ON `book` (`server`, `date`, `owner_name`, `mod`, `cost`, `item_id`)
+        '''
+    )
+    cur.execute('CREATE INDEX IF NOT EXISTS iBookFingerprint ON `book` (`fingerprint`)')
+
+
+def create_owners_table(cur):
+    # Traders of each server, history rows refer to them by `owner_id`. Totals are updated
+    # on every write, see `update_owners`, and outlive compacted history like daily rollups.
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "owners" (
+            `id`    INTEGER NOT NULL PRIMARY KEY,
+            `server`    VARCHAR NOT NULL,
+            `name`  VARCHAR NOT NULL,
+            `first_date`    DATETIME,
+            `last_date` DATETIME,
+            `demands`   INTEGER NOT NULL DEFAULT 0,
+            `offers`    INTEGER NOT NULL DEFAULT 0,
+            `demand_volume` INTEGER NOT NULL DEFAULT 0,  -- sum of count * cost
+            `offer_volume`  INTEGER NOT NULL DEFAULT 0,
+            `undercuts` INTEGER NOT NULL DEFAULT 0
+        )
+        '''
+    )
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS iOwner ON `owners` (`server`, `name`)')
+
+
+def create_alerts_table(cur):
+    # Alert subscriptions, they are matched against new dupes in memory, see analyze.AlertIndex
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "alerts" (
+            `id`    INTEGER NOT NULL PRIMARY KEY,
+            `token` VARCHAR NOT NULL,  -- subscriber
+            `server`    VARCHAR,  -- NULL matches any
+            `items` VARCHAR NOT NULL DEFAULT '',  -- comma separated item ids, empty matches any
+            `cities`    VARCHAR NOT NULL DEFAULT '',  -- comma separated city names, empty matches any
+            `min_equity`    INTEGER,
+            `max_required_aden` INTEGER,
+            `created`   DATETIME
+        )
+        '''
+    )
+    cur.execute('CREATE INDEX IF NOT EXISTS iAlertToken ON `alerts` (`token`)')
+
+
+def create_pages_table(cur):
+    # Order of fetched market pages, their bodies are stored by digest, see archive.PageArchive
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "pages" (
+            `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            `server`    VARCHAR NOT NULL,
+            `type`  INTEGER CHECK (`type` IN (1, 2)),  -- 1 demand (buy), 2 -- offer (sell)
+            `fetched`   DATETIME,
+            `digest`    VARCHAR NOT NULL,
+            `charset`   VARCHAR NOT NULL
         )
+        '''
+    )
+    # What was collected before the first archived page, it can't be rebuilt from the archive
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "archive_start" (
+            `table` VARCHAR NOT NULL PRIMARY KEY,  -- history table or `owners`
+            `max_id`    INTEGER NOT NULL  -- rows up to this id were there
+        )
+        '''
+    )
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "archive_start_rollups" (
+            `server`    VARCHAR NOT NULL,
+            `item_id`   INTEGER NOT NULL,
+            `type`  INTEGER NOT NULL,
+            `mod`   INTEGER NOT NULL,
+            `bucket`    INTEGER NOT NULL  -- daily bucket which was there
+        )
+        '''
+    )
+
+
+def mark_archive_start(cur):
+    # Called with the first archived page, see archive.rebuild. Legacy `trades` is marked
+    # as a whole until migration 4 splits it, see migrate.finish_partition.
+    cur.execute('DELETE FROM `archive_start`')
+    cur.execute('DELETE FROM `archive_start_rollups`')
+    for table in history_tables(cur) + ['owners', 'trades']:
+        if table_exists(cur, table):
+            cur.execute(
+                'INSERT INTO `archive_start` (`table`, `max_id`) SELECT ?, MAX(`id`) FROM `%s` HAVING COUNT(*)' % table,
+                (table,)
+            )
+    if table_exists(cur, 'rollups'):
         cur.execute(
             '''
-            CREATE UNIQUE INDEX iTrade
-            ON `trades` (`date`, `owner_name`, `mod`, `cost`, `item_id`)
-            '''
+            INSERT INTO `archive_start_rollups` (`server`, `item_id`, `type`, `mod`, `bucket`)
+            SELECT `server`, `item_id`, `type`, `mod`, `bucket` FROM `rollups` WHERE `period` = ?
+            ''',
+            (max(ROLLUP_PERIODS),)
+        )
+
+
+def sqlite_init_trades(filename=SQLITE_DB_FILENAME):
+    with sqlite_conn(filename=filename) as conn:
+        cur = conn.cursor()
+        create_book_table(cur)
+        create_owners_table(cur)
+
+
+def create_rollup_tables(cur):
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "rollups" (
+            `server`    VARCHAR NOT NULL,
+            `item_id`   INTEGER NOT NULL,
+            `period`    INTEGER NOT NULL,  -- bucket size, seconds
+            `type`  INTEGER NOT NULL,
+            `mod`   INTEGER NOT NULL,  -- level, or mod which is not a level, see `mod_level`
+            `bucket`    INTEGER NOT NULL,  -- bucket start, unix time
+            `open`  INTEGER,
+            `high`  INTEGER,
+            `low`   INTEGER,
+            `close` INTEGER,
+            `median`    INTEGER,
+            `volume`    INTEGER,  -- sum of counts
+            `trades`    INTEGER,
+            `open_date` DATETIME,
+            `close_date`    DATETIME,
+            PRIMARY KEY (`server`, `item_id`, `period`, `type`, `mod`, `bucket`)
+        )
+        '''
+    )
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "rollup_costs" (
+            `server`    VARCHAR NOT NULL,
+            `item_id`   INTEGER NOT NULL,
+            `period`    INTEGER NOT NULL,
+            `type`  INTEGER NOT NULL,
+            `mod`   INTEGER NOT NULL,
+            `bucket`    INTEGER NOT NULL,
+            `cost`  INTEGER NOT NULL,
+            `trades`    INTEGER NOT NULL,  -- trades with this cost in bucket, for median
+            PRIMARY KEY (`server`, `item_id`, `period`, `type`, `mod`, `bucket`, `cost`)
         )
+        '''
+    )
+
+
+def sqlite_init_rollups(filename=SQLITE_DB_FILENAME):
+    with sqlite_conn(filename=filename) as conn:
+        create_rollup_tables(conn.cursor())
@@ -0,0 +1,567 @@
+# encoding: utf-8
+
+import sys
+import json
+import time
+import argparse
+import datetime
+
+import market
+
+
+MIGRATION_BATCH_SIZE = 10000  # rows per transaction
+MIGRATION_PAUSE = 0.05  # seconds between batches, lets the crawler write in between
+
+HISTORY_COLUMNS = '`server`, `mod`, `owner_name`, `count`, `cost`, `city`, `date`, `type`, `item_id`, `fingerprint`'
+
+
+class Migration:
+    # One schema version. `prepare(cur)` makes schema changes and returns state of the first
+    # batch, or None when there is nothing to fill. `batch(cur, state, size)` processes up to
+    # `size` rows and returns state of the next batch or None. `finish(cur)` runs in the same
+    # transaction as the last batch. Every call is a separate transaction which also stores
+    # the state, so interrupted migration goes on from the last committed batch.
+
+    def __init__(self, version, name, prepare, batch=None, finish=None):
+        self.version = version
+        self.name = name
+        self.prepare = prepare
+        self.batch = batch
+        self.finish = finish
+
+    def __repr__(self):
+        return '<Migration %d %s>' % (self.version, self.name)
+
+
+def table_columns(cur, table):
+    return [row[1] for row in cur.execute('PRAGMA table_info(`%s`)' % table)]
+
+
+def _batch_tables(cur, state, size, fill):
+    # `state['tables']` are [table, since id, max id] left to fill, `fill(cur, table, since_id, until_id)`
+    # is called for the next `size` ids. Month tables dropped since the checkpoint are skipped.
+    tables = [entry for entry in state['tables'] if market.table_exists(cur, entry[0])]
+    if not tables:
+        return None
+
+    table, since_id, max_id = tables[0]
+    until_id = min(since_id + size, max_id)
+    fill(cur, table, since_id, until_id)
+
+    if until_id < max_id:
+        tables = [[table, until_id, max_id]] + tables[1:]
+    else:
+        tables = tables[1:]
+    return {'tables': tables} if tables else None
+
+
+def _archive_started(cur, where='1'):
+    # see market.mark_archive_start, databases before migration 8 may have no marks at all
+    return market.table_exists(cur, 'archive_start') and \
+        cur.execute('SELECT 1 FROM `archive_start` WHERE %s LIMIT 1' % where).fetchone() is not None
+
+
+def _next_ids(cur, table, since_id, size):
+    # (since_id, until_id] holds up to `size` rows of `table`, None when there are no rows left
+    rows = cur.execute(
+        'SELECT `id` FROM `%s` WHERE `id` > ? ORDER BY `id` LIMIT 1 OFFSET ?' % table, (since_id, size - 1)
+    ).fetchone()
+    if rows is not None:
+        return rows[0]
+    return cur.execute('SELECT MAX(`id`) FROM `%s` WHERE `id` > ?' % table, (since_id,)).fetchone()[0]
+
+
+# 1: items catalog, and tables which crawler writes to without any data to migrate, so it
+# keeps working during the next migrations
+
+def prepare_items(cur):
+    market.create_items_table(cur)
+    market.create_book_table(cur)
+    market.create_alerts_table(cur)
+    market.create_pages_table(cur)
+
+
+# 2: `server` column of single `trades` table. No indexes are built on the legacy table:
+# batches walk it by `id` and migration 4 drops it.
+
+def prepare_multi_server(cur):
+    if not market.table_exists(cur, 'trades') or 'server' in table_columns(cur, 'trades'):
+        return None
+
+    cur.execute("ALTER TABLE `trades` ADD COLUMN `server` VARCHAR NOT NULL DEFAULT 'motherland'")
+
+
+# 3: `fingerprint` of single `trades` table
+
+def prepare_fingerprint(cur):
+    if not market.table_exists(cur, 'trades'):
+        return None
+
+    if 'fingerprint' not in table_columns(cur, 'trades'):
+        cur.execute('ALTER TABLE `trades` ADD COLUMN `fingerprint` VARCHAR')
+    return {'id': 0}
+
+
+def batch_fingerprint(cur, state, size):
+    rows = cur.execute(
+        '''
+        SELECT
+            `trades`.`id`,
+            `server`,
+            `date` as "[timestamp]",
+            `city`,
+            `owner_name`,
+            `items`.`name`,
+            `mod`,
+            `item_id`
+        FROM
+            `trades`
+            LEFT JOIN `items` ON `trades`.`item_id` = `items`.`id`
+        WHERE
+            `trades`.`id` > ?
+            AND `fingerprint` IS NULL
+        ORDER BY `trades`.`id`
+        LIMIT ?
+        ''',
+        (state['id'], size)
+    ).fetchall()
+    if not rows:
+        return None
+
+    cur.executemany(
+        'UPDATE `trades` SET `fingerprint` = ? WHERE `id` = ?',
+        (
+            (market.trade_fingerprint(server, date, city, owner_name, item_name + (mod or ''), item_id), id_)
+            for id_, server, date, city, owner_name, item_name, mod, item_id in rows
+            if item_name is not None  # unknown items are never loaded, so they need no fingerprint
+        )
+    )
+    return {'id': rows[-1][0]}
+
+
+# 4: single `trades` table is split to current `book` and monthly history tables
+
+def prepare_partition(cur):
+    market.create_book_table(cur)
+    if not market.table_exists(cur, 'trades'):
+        return None
+
+    # book which crawler has written since migration 1 is newer than the last one of `trades`
+    if cur.execute('SELECT 1 FROM `book` LIMIT 1').fetchone() is None:
+        cur.execute(
+            'INSERT OR IGNORE INTO `book` (%s) SELECT %s FROM `trades` WHERE `latest` = 1' % (
+                HISTORY_COLUMNS, HISTORY_COLUMNS
+            )
+        )
+    return {'id': 0}
+
+
+def batch_partition(cur, state, size):
+    since_id = state['id']
+    until_id = _next_ids(cur, 'trades', since_id, size)
+    if until_id is None:
+        return None
+
+    months = cur.execute(
+        "SELECT DISTINCT strftime('%Y_%m', `date`) FROM `trades` WHERE `id` > ? AND `id` <= ?", (since_id, until_id)
+    ).fetchall()
+    for month, in months:
+        if month is None:
+            continue
+
+        table = market.history_table(month)
+        market.create_history_table(cur, table)
+        cur.execute(
+            '''
+            INSERT OR IGNORE INTO `%s` (%s)
+            SELECT %s FROM `trades`
+            WHERE `id` > ? AND `id` <= ? AND strftime('%%Y_%%m', `date`) = ?
+            ORDER BY `id`
+            ''' % (table, HISTORY_COLUMNS, HISTORY_COLUMNS),
+            (since_id, until_id, month)
+        )
+    return {'id': until_id}
+
+
+def finish_partition(cur):
+    if market.table_exists(cur, 'trades'):
+        cur.execute('DROP TABLE `trades`')
+
+    # archive was started before the split, copied rows are protected with everything
+    # crawler has written meanwhile, they can't be told apart
+    if _archive_started(cur, "`table` = 'trades'"):
+        cur.execute("DELETE FROM `archive_start` WHERE `table` = 'trades'")
+        for table in market.history_tables(cur):
+            cur.execute(
+                'INSERT OR REPLACE INTO `archive_start` (`table`, `max_id`) SELECT ?, MAX(`id`) FROM `%s` HAVING COUNT(*)'
+                % table,
+                (table,)
+            )
+
+
+# 5: price history rollups of already collected trades
+
+def prepare_rollups(cur):
+    if market.table_exists(cur, 'rollups'):
+        return None
+
+    # rows written after this transaction are rolled up by the crawler itself
+    market.create_rollup_tables(cur)
+    tables = []
+    for table in market.history_tables(cur):
+        max_id = cur.execute('SELECT MAX(`id`) FROM `%s`' % table).fetchone()[0]
+        if max_id:
+            tables.append([table, 0, max_id])
+    return {'tables': tables} if tables else None
+
+
+def batch_rollups(cur, state, size):
+    return _batch_tables(cur, state, size, market.update_rollups)
+
+
+def finish_rollups(cur):
+    # archive was started before rollups, daily buckets of protected history are protected too
+    if _archive_started(cur) and not cur.execute('SELECT 1 FROM `archive_start_rollups` LIMIT 1').fetchone():
+        cur.execute(
+            '''
+            INSERT INTO `archive_start_rollups` (`server`, `item_id`, `type`, `mod`, `bucket`)
+            SELECT `server`, `item_id`, `type`, `mod`, `bucket` FROM `rollups` WHERE `period` = ?
+            ''',
+            (max(market.ROLLUP_PERIODS),)
+        )
+
+
+# 6: owners dimension, `owner_id` of history rows and covering indexes
+
+def prepare_owners(cur):
+    if market.table_exists(cur, 'owners'):
+        return None
+
+    # rows written after this transaction get `owner_id` and totals from the crawler itself
+    market.create_owners_table(cur)
+    tables = []
+    indexes = market.history_tables(cur)
+    for table in indexes:
+        if 'owner_id' not in table_columns(cur, table):
+            cur.execute('ALTER TABLE `%s` ADD COLUMN `owner_id` INTEGER REFERENCES "owners"(`id`)' % table)
+        max_id = cur.execute('SELECT MAX(`id`) FROM `%s`' % table).fetchone()[0]
+        if max_id:
+            tables.append([table, 0, max_id])
+    # `indexes` are month tables left to index after all of `tables` are filled
+    return {'tables': tables, 'indexes': indexes} if indexes else None
+
+
+def batch_owners(cur, state, size):
+    # checkpoints made before index builds were batched have no `indexes`
+    indexes = state.get('indexes')
+    if indexes is None:
+        indexes = market.history_tables(cur)
+
+    if state['tables']:
+        filled = _batch_tables(cur, state, size, _fill_owners)
+        return {'tables': filled['tables'] if filled else [], 'indexes': indexes}
+
+    # covering indexes of one existing month table per transaction, new ones are indexed on creation
+    indexes = [table for table in indexes if market.table_exists(cur, table)]
+    if not indexes:
+        return None
+    market.create_history_indexes(cur, indexes[0])
+    return {'tables': [], 'indexes': indexes[1:]} if indexes[1:] else None
+
+
+def _fill_owners(cur, table, since_id, until_id):
+    cur.execute(
+        '''
+        INSERT OR IGNORE INTO `owners` (`server`, `name`)
+        SELECT DISTINCT `server`, `owner_name` FROM `%s` WHERE `id` > ? AND `id` <= ?
+        ''' % table,
+        (since_id, until_id)
+    )
+    cur.execute(
+        '''
+        UPDATE `%s` SET `owner_id` = (
+            SELECT `id` FROM `owners` WHERE `owners`.`server` = `%s`.`server` AND `owners`.`name` = `owner_name`
+        )
+        WHERE `id` > ? AND `id` <= ?
+        ''' % (table, table),
+        (since_id, until_id)
+    )
+    market.update_owners(cur, table, since_id, until_id)
+
+
+# 7: alert subscriptions
+
+def prepare_alerts(cur):
+    market.create_alerts_table(cur)
+
+
+# 8: archive of fetched pages
+
+def prepare_pages(cur):
+    market.create_pages_table(cur)
+    # pages archived by older code, which didn't mark the start: all collected so far is protected
+    if cur.execute('SELECT 1 FROM `pages` LIMIT 1').fetchone() and not _archive_started(cur):
+        market.mark_archive_start(cur)
+
+
+# 9: price buckets keyed by mod level, '+3' and '3' are the same bucket
+
+def prepare_rollups_mod_level(cur):
+    columns = {row[1]: row[2] for row in cur.execute('PRAGMA table_info(`rollups`)')}
+    if columns['mod'] == 'INTEGER':
+        return None
+
+    # buckets written after this transaction go to new tables, old ones are merged into them
+    cur.execute('ALTER TABLE `rollups` RENAME TO `rollups_v8`')
+    cur.execute('ALTER TABLE `rollup_costs` RENAME TO `rollup_costs_v8`')
+    market.create_rollup_tables(cur)
+    if market.table_exists(cur, 'archive_start_rollups'):
+        cur.execute('UPDATE `archive_start_rollups` SET `mod` = %s' % market.mod_level_sql('`mod`'))
+    if cur.execute('SELECT 1 FROM `rollups_v8` LIMIT 1').fetchone() is None:
+        return None
+    return {'merged': 0}
+
+
+def batch_rollups_mod_level(cur, state, size):
+    # Merged buckets are deleted from old tables, so a batch is always the first `size` left
+    rows = cur.execute(
+        '''
+        SELECT
+            `rowid`, `server`, `item_id`, `period`, `type`, `mod`, `bucket`,
+            `open`, `high`, `low`, `close`, `median`, `volume`, `trades`,
+            `open_date` as "[timestamp]", `close_date` as "[timestamp]"
+        FROM `rollups_v8` LIMIT ?
+        ''',
+        (size,)
+    ).fetchall()
+    for row in rows:
+        _merge_rollup(cur, row[1:7], row[7:])
+
+    cur.executemany('DELETE FROM `rollups_v8` WHERE `rowid` = ?', ((row[0],) for row in rows))
+    if cur.execute('SELECT 1 FROM `rollups_v8` LIMIT 1').fetchone() is None:
+        return None
+    return {'merged': state['merged'] + len(rows)}
+
+
+def _merge_rollup(cur, old_key, bucket):
+    # Old bucket goes to its mod level, '' and '+0' or '+3' and '3' are merged into one
+    server, item_id, period, type_, mod, start = old_key
+    key = (server, item_id, period, type_, market.mod_level(mod), start)
+    open_, high, low, close, median, volume, trades, open_date, close_date = bucket
+
+    costs = cur.execute(
+        '''
+        SELECT `cost`, `trades` FROM `rollup_costs_v8`
+        WHERE `server` = ? AND `item_id` = ? AND `period` = ? AND `type` = ? AND `mod` = ? AND `bucket` = ?
+        ''',
+        old_key
+    ).fetchall()
+    cur.executemany(
+        '''
+        INSERT OR IGNORE INTO `rollup_costs` (`server`, `item_id`, `period`, `type`, `mod`, `bucket`, `cost`, `trades`)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+        ''',
+        (key + (cost,) for cost, _ in costs)
+    )
+    cur.executemany(
+        '''
+        UPDATE `rollup_costs` SET `trades` = `trades` + ?
+        WHERE `server` = ? AND `item_id` = ? AND `period` = ? AND `type` = ? AND `mod` = ? AND `bucket` = ? AND `cost` = ?
+        ''',
+        ((n,) + key + (cost,) for cost, n in costs)
+    )
+
+    prev = cur.execute(
+        '''
+        SELECT
+            `open`, `high`, `low`, `close`, `volume`, `trades`,
+            `open_date` as "[timestamp]", `close_date` as "[timestamp]"
+        FROM `rollups`
+        WHERE `server` = ? AND `item_id` = ? AND `period` = ? AND `type` = ? AND `mod` = ? AND `bucket` = ?
+        ''',
+        key
+    ).fetchone()
+    if prev is not None:
+        prev_open, prev_high, prev_low, prev_close, prev_volume, prev_trades, prev_open_date, prev_close_date = prev
+        if prev_open_date <= open_date:
+            open_, open_date = prev_open, prev_open_date
+        if prev_close_date > close_date:
+            close, close_date = prev_close, prev_close_date
+        high = max(high, prev_high)
+        low = min(low, prev_low)
+        volume += prev_volume
+        trades += prev_trades
+        median = market._lower_median(
+            cur.execute(
+                '''
+                SELECT `cost`, `trades` FROM `rollup_costs`
+                WHERE `server` = ? AND `item_id` = ? AND `period` = ? AND `type` = ? AND `mod` = ? AND `bucket` = ?
+                ORDER BY `cost`
+                ''',
+                key
+            ),
+            trades
+        )
+
+    cur.execute(
+        '''
+        INSERT OR REPLACE INTO `rollups` (
+            `server`, `item_id`, `period`, `type`, `mod`, `bucket`,
+            `open`, `high`, `low`, `close`, `median`, `volume`, `trades`, `open_date`, `close_date`
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''',
+        key + (open_, high, low, close, median, volume, trades, open_date, close_date)
+    )
+
+
+def finish_rollups_mod_level(cur):
+    cur.execute('DROP TABLE IF EXISTS `rollups_v8`')
+    cur.execute('DROP TABLE IF EXISTS `rollup_costs_v8`')
+
+
+MIGRATIONS = (
+    Migration(1, 'items', prepare_items),
+    Migration(2, 'multi_server', prepare_multi_server),
+    Migration(3, 'fingerprint', prepare_fingerprint, batch_fingerprint),
+    Migration(4, 'partition', prepare_partition, batch_partition, finish_partition),
+    Migration(5, 'rollups', prepare_rollups, batch_rollups, finish_rollups),
+    Migration(6, 'owners', prepare_owners, batch_owners),
+    Migration(7, 'alerts', prepare_alerts),
+    Migration(8, 'pages', prepare_pages),
+    Migration(9, 'rollups_mod_level', prepare_rollups_mod_level, batch_rollups_mod_level, finish_rollups_mod_level),
+)
+
+
+def create_migrations_table(cur):
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS `schema_migrations` (
+            `version`   INTEGER NOT NULL PRIMARY KEY,
+            `name`  VARCHAR NOT NULL,
+            `state` VARCHAR,  -- json of the next batch, NULL when applied
+            `started`   DATETIME,
+            `applied`   DATETIME
+        )
+        '''
+    )
+
+
+def get_status(filename=market.SQLITE_DB_FILENAME):
+    # version -> (state, applied) of started migrations
+    with market.sqlite_conn(filename=filename) as conn:
+        cur = conn.cursor()
+        create_migrations_table(cur)
+        return {
+            version: (None if state is None else json.loads(state), applied)
+            for version, state, applied in cur.execute(
+                'SELECT `version`, `state`, `applied` FROM `schema_migrations`'
+            )
+        }
+
+
+def get_version(filename=market.SQLITE_DB_FILENAME):
+    applied = [version for version, (_, applied) in get_status(filename).items() if applied is not None]
+    return max(applied, default=0)
+
+
+def _step(filename, migration, state, size):
+    # One transaction: prepare or next batch, finish after the last one, and the checkpoint
+    with market.sqlite_conn(filename=filename) as conn:
+        cur = conn.cursor()
+        now = datetime.datetime.now()
+
+        if state is None:
+            state = migration.prepare(cur)
+            cur.execute(
+                'INSERT INTO `schema_migrations` (`version`, `name`, `started`) VALUES (?, ?, ?)',
+                (migration.version, migration.name, now)
+            )
+        else:
+            state = migration.batch(cur, state, size)
+
+        if state is not None and migration.batch is None:
+            raise RuntimeError('%r has no batches, but prepared state %r' % (migration, state))
+
+        applied = None
+        if state is None:
+            if migration.finish is not None:
+                migration.finish(cur)
+            applied = now
+
+        cur.execute(
+            'UPDATE `schema_migrations` SET `state` = ?, `applied` = ? WHERE `version` = ?',
+            (None if state is None else json.dumps(state), applied, migration.version)
+        )
+
+    return state
+
+
+def migrate(filename=market.SQLITE_DB_FILENAME, target=None, batch_size=MIGRATION_BATCH_SIZE,
+            pause=MIGRATION_PAUSE, migrations=MIGRATIONS, on_step=None):
+    # Apply pending migrations up to `target` version in order, returns applied versions.
+    # `on_step(migration, state)` is called after every committed step, see bench.check_migrations.
+    status = get_status(filename)
+    applied = []
+
+    for migration in migrations:
+        if target is not None and migration.version > target:
+            break
+
+        state, applied_at = status.get(migration.version, (None, None))
+        if applied_at is not None:
+            continue
+
+        if migration.version not in status:
+            print('%d %s: started' % (migration.version, migration.name))
+            state = _step(filename, migration, None, batch_size)
+            if on_step is not None:
+                on_step(migration, state)
+        else:
+            print('%d %s: resumed at %s' % (migration.version, migration.name, json.dumps(state)))
+
+        while state is not None:
+            time.sleep(pause)
+            state = _step(filename, migration, state, batch_size)
+            if on_step is not None:
+                on_step(migration, state)
+            if state is not None:
+                print('%d %s: %s' % (migration.version, migration.name, json.dumps(state)))
+
+        # names cache may be stale after a migration of `items`
+        market.get_db(filename).forget_item_names()
+
+        print('%d %s: applied' % (migration.version, migration.name))
+        applied.append(migration.version)
+
+    return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create or upgrade market database schema')
+    parser.add_argument('--db', default=market.SQLITE_DB_FILENAME)
+    parser.add_argument('--target', type=int, default=None, help='stop at this version')
+    parser.add_argument('--batch', type=int, default=MIGRATION_BATCH_SIZE, help='rows per transaction')
+    parser.add_argument('--status', action='store_true', help='print schema version and exit')
+    args = parser.parse_args(argv)
+
+    if args.status:
+        status = get_status(args.db)
+        for migration in MIGRATIONS:
+            state, applied = status.get(migration.version, (None, None))
+            if applied is not None:
+                progress = 'applied %s' % applied
+            elif migration.version in status:
+                progress = 'interrupted at %s' % json.dumps(state)
+            else:
+                progress = 'pending'
+            print('%d %s: %s' % (migration.version, migration.name, progress))
+    else:
+        migrate(args.db, target=args.target, batch_size=args.batch)
+
+    market.close_db()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
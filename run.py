@@ -1,16 +1,236 @@
 # encoding: utf-8
 
+import gzip
 import json
+import uuid
+import random
 import asyncio
+import datetime
+import functools
+import collections
 
 from aiohttp import web
 from concurrent.futures import ThreadPoolExecutor
 
+import fetch
 import market
+import archive
 import analyze
 
 
 SHARED_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+READ_EXECUTOR = ThreadPoolExecutor(max_workers=market.SQLITE_READERS)  # reads must not wait for writes
+# MarketBook is not thread safe: every change, match and render of it goes through this single worker
+ANALYZE_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+PARSE_EXECUTOR = ThreadPoolExecutor(max_workers=2)  # downloaded pages are tokenized and parsed off the loop
+
+SCRAPE_INTERVAL = 120
+SCRAPE_MIN_INTERVAL = 60
+SCRAPE_MAX_INTERVAL = 600
+SCRAPE_BACKOFF = 1.5  # interval growth while market does not change
+SCRAPE_JITTER = 0.1  # part of interval, spreads servers in time
+ACTIVE_HOURS = range(17, 24)  # local time, most of players are online
+
+COMPACT_INTERVAL = 24 * 3600  # drop history older than retention, see market.compact_history
+COMPACT_RETRY_INTERVAL = 600  # while migrate.py has not finished
+
+DUPE_MAX_LIMIT = 1000
+TRADER_MAX_LIMIT = 1000
+ALERTS_PER_TOKEN = 100
+GZIP_MIN_SIZE = 1024  # smaller filtered answers are sent as is
+
+STREAM_PING_INTERVAL = 30
+STREAM_QUEUE_SIZE = 16
+
+
+class PollInterval:
+    def __init__(self, interval=SCRAPE_INTERVAL, min_interval=SCRAPE_MIN_INTERVAL,
+                 max_interval=SCRAPE_MAX_INTERVAL, backoff=SCRAPE_BACKOFF, active_hours=ACTIVE_HOURS):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.active_hours = active_hours
+
+        self.current = interval
+
+    def base(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        if now.hour in self.active_hours:
+            return max(self.min_interval, self.interval / 2)
+        return self.interval
+
+    def next(self, changed, now=None):
+        base = self.base(now)
+        if changed:
+            self.current = base
+        else:
+            self.current = min(self.max_interval, max(base, self.current * self.backoff))
+        return jittered(self.current)
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one computation in executor
+    def __init__(self, executor):
+        self.executor = executor
+        self._futures = {}
+
+    def run(self, key, func, *args, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        future = self._futures.get(key)
+        if future is None:
+            future = self._futures[key] = loop.run_in_executor(self.executor, func, *args)
+            future.add_done_callback(lambda _: self._futures.pop(key, None))
+
+        # waiter which is gone (client disconnected) must not cancel result for the others
+        return asyncio.shield(future, loop=loop)
+
+
+ANALYSIS = SingleFlight(ANALYZE_EXECUTOR)
+
+
+class DupeStream:
+    def __init__(self):
+        self.queues = {}  # queue -> server filter
+        self.snapshot = None
+
+    def subscribe(self, server=None):
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.queues[queue] = server
+        return queue
+
+    def unsubscribe(self, queue):
+        self.queues.pop(queue, None)
+
+    def current(self):
+        # Diffs are published against this snapshot, so new subscribers must start from it
+        if self.snapshot is None:
+            self.snapshot = analyze.get_snapshot()
+        return self.snapshot
+
+    @staticmethod
+    def encode_diffs(snapshot, prev, servers):
+        # encode once per server filter, not per subscriber
+        return {
+            server: sse_message('diff', json.dumps(snapshot.diff(prev, server=server)), event_id=snapshot.version)
+            for server in servers
+        }
+
+    @asyncio.coroutine
+    def publish(self, snapshot, loop=None):
+        # Returns previous snapshot, or None when this one is already published
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        if self.snapshot is not None and self.snapshot.version == snapshot.version:
+            return None
+
+        # Who subscribes from now on starts from the new snapshot and must not get this diff
+        prev, self.snapshot = self.snapshot, snapshot
+        subscribers = list(self.queues.items())
+
+        messages = yield from loop.run_in_executor(
+            ANALYZE_EXECUTOR, self.encode_diffs, snapshot, prev, {server for _, server in subscribers}
+        )
+
+        for queue, server in subscribers:
+            if queue not in self.queues:
+                continue
+
+            try:
+                queue.put_nowait(messages[server])
+            except asyncio.QueueFull:
+                # Client does not read stream, drop it. It will reconnect and get full snapshot.
+                self.unsubscribe(queue)
+                close_queue(queue)
+
+        return prev
+
+
+DUPE_STREAM = DupeStream()
+
+
+class AlertStream:
+    # Server side alert subscriptions. Only dupes which are new in a published snapshot are
+    # matched, once for all subscribers, see analyze.AlertIndex. Matches are sent to streams
+    # of their subscribers, alerts of subscribers which are not connected are not kept.
+    def __init__(self):
+        self.index = analyze.AlertIndex()
+        self.queues = {}  # queue -> token
+
+    def load(self):
+        self.index = analyze.AlertIndex(market.get_alerts())
+
+    def subscribe(self, token):
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.queues[queue] = token
+        return queue
+
+    def unsubscribe(self, queue):
+        self.queues.pop(queue, None)
+
+    def encode_matches(self, snapshot, prev, tokens):
+        prev_ids = {d['id'] for d in prev.items}
+        matched = self.index.match(d for d in snapshot.items if d['id'] not in prev_ids)
+
+        alerts = collections.defaultdict(list)  # token -> matched alerts
+        for alert_id, dupes in sorted(matched.items()):
+            token = self.index.alerts[alert_id]['token']
+            if token in tokens:
+                alerts[token].append({'id': alert_id, 'dupes': dupes})
+
+        return {
+            token: sse_message(
+                'alert', json.dumps({'version': snapshot.version, 'alerts': token_alerts}), event_id=snapshot.version
+            )
+            for token, token_alerts in alerts.items()
+        }
+
+    @asyncio.coroutine
+    def publish(self, snapshot, prev, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        subscribers = list(self.queues.items())
+        if not subscribers:
+            return
+
+        # index is changed in the same executor, see `add_alert`
+        messages = yield from loop.run_in_executor(
+            ANALYZE_EXECUTOR, self.encode_matches, snapshot, prev, {token for _, token in subscribers}
+        )
+
+        for queue, token in subscribers:
+            message = messages.get(token)
+            if message is None or queue not in self.queues:
+                continue
+
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.unsubscribe(queue)
+                close_queue(queue)
+
+
+ALERT_STREAM = AlertStream()
+
+
+def close_queue(queue):
+    # Stream of this queue ends after pending messages are dropped
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+def sse_message(event, data, event_id=None):
+    lines = ['event: %s' % event]
+    if event_id is not None:
+        lines.append('id: %s' % event_id)
+    lines.extend('data: %s' % line for line in data.splitlines())
+    return ('\n'.join(lines) + '\n\n').encode()
 
 
 def log_future_exception(future):
@@ -19,55 +239,465 @@ def log_future_exception(future):
         print("Critical exception occured: %r" % exc)
 
 
+def jittered(interval, jitter=SCRAPE_JITTER):
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+@asyncio.coroutine
+def apply_trades(trades, delta, loop):
+    if delta is None:
+        yield from loop.run_in_executor(SHARED_EXECUTOR, trades.write, True)
+        yield from loop.run_in_executor(ANALYZE_EXECUTOR, analyze.MARKET.sync, trades)
+        return True
+
+    added, removed = delta
+    if not added and not removed:
+        return False
+
+    yield from loop.run_in_executor(SHARED_EXECUTOR, market.TradeList.write_delta, added, removed)
+    yield from loop.run_in_executor(ANALYZE_EXECUTOR, analyze.MARKET.apply, added, removed)
+    return True
+
+
 @asyncio.coroutine
-def update_market(loop=None):
+def update_market(fetcher, loop=None):
     if loop is None:
         loop = asyncio.get_event_loop()
 
+    poll = PollInterval()
+    yield from asyncio.sleep(random.uniform(0, SCRAPE_INTERVAL * SCRAPE_JITTER), loop=loop)
+
     while True:
         try:
-            trades = yield from asyncio.wait_for(
-                loop.run_in_executor(SHARED_EXECUTOR, market.get_trades, True),
-                timeout=120
-            )
-            trades.write(latest=True)
+            trades, delta = yield from asyncio.wait_for(fetcher.fetch(), timeout=120, loop=loop)
+
+            changed = False
+            if trades is not None:
+                try:
+                    changed = yield from apply_trades(trades, delta, loop)
+                except Exception:
+                    # db or book may miss this generation, so start over from the full one
+                    fetcher.reset()
+                    raise
 
-            yield from asyncio.sleep(120, loop=loop)
+            if changed:
+                snapshot = yield from ANALYSIS.run((analyze.MARKET.version, None), analyze.get_snapshot, loop=loop)
+                prev = yield from DUPE_STREAM.publish(snapshot, loop=loop)
+                if prev is not None:
+                    yield from ALERT_STREAM.publish(snapshot, prev, loop=loop)
+
+            yield from asyncio.sleep(poll.next(changed), loop=loop)
         except asyncio.TimeoutError:
-            print("TimeoutError occured. Try again!")
+            print("[%s] TimeoutError occured. Try again!" % fetcher.server)
         except Exception as exc:
-            print("Unhandled exception occured: %r" % exc)
+            print("[%s] Unhandled exception occured: %r" % (fetcher.server, exc))
             print("Sleep...")
             yield from asyncio.sleep(10, loop=loop)
             print("Wake up!")
 
 
+@asyncio.coroutine
+def compact_history(loop=None):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    while True:
+        interval = COMPACT_INTERVAL
+        try:
+            dropped = yield from loop.run_in_executor(SHARED_EXECUTOR, market.compact_history)
+            if dropped:
+                print("History compacted: %s" % ', '.join(dropped))
+        except RuntimeError as exc:
+            # schema is not migrated yet, crawler goes on writing, history is kept until then
+            print("History compaction postponed: %s" % exc)
+            interval = COMPACT_RETRY_INTERVAL
+        except Exception as exc:
+            print("Unhandled exception occured: %r" % exc)
+
+        yield from asyncio.sleep(interval, loop=loop)
+
+
+def start_crawl(servers=market.SERVERS, loop=None):
+    # Each server is crawled by its own task, so slow one does not delay others.
+    # All of them share keep-alive connections and per-host rate limits.
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    session = fetch.create_session(loop)
+    limiter = fetch.HostLimiter(loop=loop)
+    page_archive = archive.PageArchive()
+
+    tasks = []
+    for server in servers:
+        fetcher = fetch.MarketFetcher(
+            server, session=session, limiter=limiter, archive=page_archive, executor=PARSE_EXECUTOR, loop=loop
+        )
+        task = asyncio.async(update_market(fetcher, loop=loop), loop=loop)
+        task.add_done_callback(log_future_exception)
+        tasks.append(task)
+
+    return tasks
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('IF-NONE-MATCH')
+    if not if_none_match:
+        return False
+    return etag in (e.strip() for e in if_none_match.split(','))
+
+
+def int_param(request, name, default=None):
+    return int_value(request.GET, name, default)
+
+
+def int_value(params, name, default=None):
+    value = params.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text='%s must be integer' % name)
+
+
+def accepts_gzip(request):
+    for coding in request.headers.get('ACCEPT-ENCODING', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        return quality > 0
+    return False
+
+
+def render_dupes(ignore, server, with_result, query=None, compact=False, use_gzip=False):
+    # Snapshot is filtered by ignore list and cached for the same list until next update.
+    # Full lists are serialized and compressed once per snapshot, filtered pages per request.
+    snapshot = analyze.get_snapshot(ignore)
+    etag = snapshot.get_etag(snapshot.ignored, server=server, query=query)
+    encoding = None
+
+    if query is not None:
+        body = snapshot.get_query_body(query, server, with_ignored=with_result, compact=compact)
+        if use_gzip and len(body) >= GZIP_MIN_SIZE:
+            body = gzip.compress(body, analyze.GZIP_LEVEL)
+            encoding = 'gzip'
+    else:
+        if compact:
+            body = snapshot.get_compact_body(server, with_ignored=with_result)
+        elif with_result:
+            body = snapshot.get_result_body(server)
+        else:
+            body = snapshot.get_body(server)
+        if use_gzip:
+            body = snapshot.get_compressed((server, with_result, compact), body)
+            encoding = 'gzip'
+
+    # representations differ, so do their tags
+    variant = ''.join((
+        '-result' if with_result else '',
+        '-compact' if compact else '',
+        '-gzip' if encoding else '',
+    ))
+    if variant:
+        etag = etag[:-1] + variant + '"'
+    return etag, body, encoding
+
+
+def dupe_query(request):
+    # Without any of filters or page params answer is the full list, as before
+    limit = int_param(request, 'limit')
+    if limit is not None and not 0 < limit <= DUPE_MAX_LIMIT:
+        raise web.HTTPBadRequest(text='limit must be in 1..%d' % DUPE_MAX_LIMIT)
+
+    params = {
+        'min_equity': int_param(request, 'min_equity'),
+        'max_required_aden': int_param(request, 'max_required_aden'),
+        'item': request.GET.get('item') or None,
+        'city': request.GET.get('city') or None,
+        'limit': limit,
+        'cursor': request.GET.get('cursor') or None,
+    }
+    if all(value is None for value in params.values()):
+        return None
+
+    try:
+        return analyze.DupeQuery(**params)
+    except ValueError as exc:
+        raise web.HTTPBadRequest(text=str(exc))
+
+
 @asyncio.coroutine
 def dupe(request):
     post_data = yield from request.post()
     ignore = post_data.get('ignore') or None
     if ignore is not None:
-        ignore = json.loads(ignore)
+        ignore = frozenset(json.loads(ignore))
+    server = request.GET.get('server') or None
+    with_result = bool(post_data)
+    query = dupe_query(request)
+    compact = request.GET.get('format') == 'compact'
+    use_gzip = accepts_gzip(request)
+
+    # Polls of the same market version with the same ignore list and filters wait for one computation
+    key = (analyze.MARKET.version, ignore, server, with_result, query, compact, use_gzip)
+    etag, body, encoding = yield from ANALYSIS.run(
+        key, render_dupes, ignore, server, with_result, query, compact, use_gzip
+    )
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return web.Response(body=body, headers=headers)
+
+
+def render_plan(budget, server, city):
+    snapshot = analyze.get_snapshot()
+    etag = snapshot.get_etag(server=server, query=('plan', budget, city))
+    return etag, snapshot.get_plan_body(budget, server=server, city=city)
+
+
+@asyncio.coroutine
+def plan(request):
+    budget = int_param(request, 'budget')
+    if budget is None or budget <= 0:
+        raise web.HTTPBadRequest(text='budget must be positive integer')
+    server = request.GET.get('server') or None
+    city = request.GET.get('city') or None
+
+    key = ('plan', analyze.MARKET.version, budget, server, city)
+    etag, body = yield from ANALYSIS.run(key, render_plan, budget, server, city)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
 
-    dupes, ignored = analyze.get_dupes(ignore_trades=ignore)
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
 
-    result = [d.to_dict() for d in dupes]
-    if post_data:
-        result = {'dupes': result, 'ignored': ignored}
+    return web.Response(body=body, headers=headers)
+
+
+@asyncio.coroutine
+def history(request):
+    try:
+        item_id = int(request.match_info['item_id'])
+    except ValueError:
+        raise web.HTTPBadRequest(text='item_id must be integer')
+
+    period = int_param(request, 'period', market.ROLLUP_PERIODS[0])
+    if period not in market.ROLLUP_PERIODS:
+        raise web.HTTPBadRequest(text='period must be one of %s' % ', '.join(map(str, market.ROLLUP_PERIODS)))
+
+    query = functools.partial(
+        market.get_history,
+        item_id,
+        server=request.GET.get('server') or market.DEFAULT_SERVER,
+        period=period,
+        type_=int_param(request, 'type'),
+        mod=int_param(request, 'mod'),  # level, '+3' and '3' are the same
+        since=int_param(request, 'since'),
+        until=int_param(request, 'until'),
+    )
+    loop = asyncio.get_event_loop()
+    buckets = yield from loop.run_in_executor(READ_EXECUTOR, query)
+
+    body = json.dumps({'item_id': item_id, 'period': period, 'buckets': buckets}).encode()
+    return web.Response(body=body, headers={'Cache-Control': 'no-cache'})
+
+
+@asyncio.coroutine
+def trader(request):
+    limit = int_param(request, 'limit', market.TRADER_PAGE_SIZE)
+    if not 0 < limit <= TRADER_MAX_LIMIT:
+        raise web.HTTPBadRequest(text='limit must be in 1..%d' % TRADER_MAX_LIMIT)
+
+    query = functools.partial(
+        market.get_trader,
+        request.match_info['name'],
+        server=request.GET.get('server') or market.DEFAULT_SERVER,
+        limit=limit,
+        cursor=request.GET.get('cursor'),
+    )
+    loop = asyncio.get_event_loop()
+    try:
+        result = yield from loop.run_in_executor(READ_EXECUTOR, query)
+    except ValueError as exc:
+        raise web.HTTPBadRequest(text=str(exc))
+
+    if result is None:
+        raise web.HTTPNotFound(text='Unknown trader')
 
     body = json.dumps(result).encode()
-    return web.Response(body=body)
+    return web.Response(body=body, headers={'Cache-Control': 'no-cache'})
+
+
+def alert_token(request):
+    token = request.GET.get('token')
+    if not token:
+        raise web.HTTPBadRequest(text='token is required')
+    return token
+
+
+def alert_params(data):
+    try:
+        items = [int(item_id) for item_id in data.get('items', '').split(',') if item_id.strip()]
+    except ValueError:
+        raise web.HTTPBadRequest(text='items must be comma separated item ids')
+
+    server = data.get('server') or None
+    if server is not None and server not in market.SERVERS:
+        raise web.HTTPBadRequest(text='server must be one of %s' % ', '.join(market.SERVERS))
+
+    return {
+        'server': server,
+        'items': items,
+        'cities': [analyze.city_name(city) for city in data.get('cities', '').split(',') if city.strip()],
+        'min_equity': int_value(data, 'min_equity'),
+        'max_required_aden': int_value(data, 'max_required_aden'),
+    }
+
+
+@asyncio.coroutine
+def alerts(request):
+    loop = asyncio.get_event_loop()
+    token = alert_token(request)
+    result = yield from loop.run_in_executor(READ_EXECUTOR, market.get_alerts, token)
+
+    body = json.dumps({'token': token, 'alerts': result}).encode()
+    return web.Response(body=body, headers={'Cache-Control': 'no-cache'})
+
+
+@asyncio.coroutine
+def add_alert(request):
+    # New subscriber gets a token, it is passed to list, delete and stream its alerts
+    data = yield from request.post()
+    token = data.get('token') or uuid.uuid4().hex
+    params = alert_params(data)
+
+    loop = asyncio.get_event_loop()
+    existing = yield from loop.run_in_executor(READ_EXECUTOR, market.get_alerts, token)
+    if len(existing) >= ALERTS_PER_TOKEN:
+        raise web.HTTPBadRequest(text='no more than %d alerts per token' % ALERTS_PER_TOKEN)
+
+    alert = yield from loop.run_in_executor(SHARED_EXECUTOR, functools.partial(market.add_alert, token, **params))
+    yield from loop.run_in_executor(ANALYZE_EXECUTOR, ALERT_STREAM.index.add, alert)
+
+    return web.Response(status=201, body=json.dumps(alert).encode(), headers={'Cache-Control': 'no-cache'})
+
+
+@asyncio.coroutine
+def delete_alert(request):
+    try:
+        alert_id = int(request.match_info['alert_id'])
+    except ValueError:
+        raise web.HTTPBadRequest(text='alert_id must be integer')
+    token = alert_token(request)
+
+    loop = asyncio.get_event_loop()
+    deleted = yield from loop.run_in_executor(SHARED_EXECUTOR, market.delete_alert, token, alert_id)
+    if not deleted:
+        raise web.HTTPNotFound(text='Unknown alert')
+    yield from loop.run_in_executor(ANALYZE_EXECUTOR, ALERT_STREAM.index.remove, alert_id)
+
+    return web.Response(status=204)
+
+
+def start_stream(request):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/event-stream'
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # nginx must not buffer events
+    resp.start(request)
+    return resp
+
+
+@asyncio.coroutine
+def write_stream(resp, queue):
+    # Messages of the queue until it is closed, pings while there are none
+    while True:
+        try:
+            message = yield from asyncio.wait_for(queue.get(), STREAM_PING_INTERVAL)
+        except asyncio.TimeoutError:
+            message = b': ping\n\n'
+
+        if message is None:
+            break
+
+        resp.write(message)
+        yield from resp.drain()
+
+
+@asyncio.coroutine
+def dupe_stream(request):
+    resp = start_stream(request)
+
+    server = request.GET.get('server') or None
+    queue = DUPE_STREAM.subscribe(server)
+    try:
+        snapshot = DUPE_STREAM.current()
+        # body is encoded lazily, in the same worker as the rest of snapshot encoding
+        loop = asyncio.get_event_loop()
+        body = yield from loop.run_in_executor(ANALYZE_EXECUTOR, snapshot.get_body, server)
+        resp.write(sse_message('snapshot', body.decode(), event_id=snapshot.version))
+        yield from write_stream(resp, queue)
+    finally:
+        DUPE_STREAM.unsubscribe(queue)
+
+    return resp
+
+
+@asyncio.coroutine
+def alert_stream(request):
+    # Only `alert` events with new dupes matched by alerts of the token, no snapshot
+    token = alert_token(request)
+    resp = start_stream(request)
+
+    queue = ALERT_STREAM.subscribe(token)
+    try:
+        yield from write_stream(resp, queue)
+    finally:
+        ALERT_STREAM.unsubscribe(queue)
+
+    return resp
 
 
 if __name__ == '__main__':
     app = web.Application()
     app.router.add_route('GET', '/api/dupe', dupe)
     app.router.add_route('POST', '/api/dupe', dupe)
+    app.router.add_route('GET', '/api/dupe/stream', dupe_stream)
+    app.router.add_route('GET', '/api/history/{item_id}', history)
+    app.router.add_route('GET', '/api/trader/{name}', trader)
+    app.router.add_route('GET', '/api/plan', plan)
+    app.router.add_route('GET', '/api/alerts', alerts)
+    app.router.add_route('POST', '/api/alerts', add_alert)
+    app.router.add_route('GET', '/api/alerts/stream', alert_stream)
+    app.router.add_route('DELETE', '/api/alerts/{alert_id}', delete_alert)
 
     loop = asyncio.get_event_loop()
 
-    upd_task = asyncio.async(update_market())
-    upd_task.add_done_callback(log_future_exception)
+    version = market.get_schema_version()
+    if version < market.SCHEMA_VERSION:
+        # crawler writes during migration, but history must not be compacted until it is done
+        print('Database schema is at version %d of %d, history compaction waits for migrate.py' % (
+            version, market.SCHEMA_VERSION
+        ))
+
+    # Book must be loaded before crawl, scrapes are applied to it as deltas
+    analyze.get_market()
+    DUPE_STREAM.current()
+    ALERT_STREAM.load()
+    start_crawl(loop=loop)
+    asyncio.async(compact_history(loop=loop), loop=loop).add_done_callback(log_future_exception)
 
     f = loop.create_server(app.make_handler(), '0.0.0.0', 8080)
     srv = loop.run_until_complete(f)
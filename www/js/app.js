@@ -1,11 +1,13 @@
 var settings = {
 	url: '/api/dupe',
+	streamUrl: '/api/dupe/stream',
 	timeout: 30
 }
 var app = angular.module('dupe-alert',['ngSanitize']);
 
 app.controller('DupeController', ['$http','$scope',function($http,$scope){
 	var ZCclient;
+	var etag;
 	var dupe = this;
 	dupe.offers = [];
 	//init wasted offers
@@ -56,56 +58,90 @@ app.controller('DupeController', ['$http','$scope',function($http,$scope){
 		localStorage.knownOffers = JSON.stringify(knownOffersArrayNew);
 	});
 	
+	var showOffers = function(data){
+		dupe.offers = data;
+		var oldOffersArray = JSON.parse(localStorage.oldOffers);
+		var oldOffersArrayNew = [];
+		var knownOffersArray = JSON.parse(localStorage.knownOffers);
+		var knownOffersArrayNew = [];
+		var id = "";
+		var unknownOffer = false;
+		for (var i = 0; i < dupe.offers.length; i++) {
+			id = dupe.offers[i].seller.date + '' + dupe.offers[i].buyer.date;
+			//is it old offer?
+			if (oldOffersArray.indexOf(id) != -1) {
+				//yeap, wasted
+				dupe.offers[i].old = true;
+				//show as wasted
+				oldOffersArrayNew.push(id);
+			} else {
+				//unchecked offer
+				dupe.offers[i].old = false;
+			}
+			//is it known offer?
+			if ((knownOffersArray.indexOf(id) != -1) || (dupe.offers[i].equity < $scope.minEquity && $scope.minEquityOn) || (dupe.offers[i].required_aden > $scope.maxRrequired && $scope.maxRrequiredOn) ) {
+				//yeap, nothing happens here
+				//keep in known array
+				knownOffersArrayNew.push(id);
+			} else {
+				//yay, new offers! flagged
+				unknownOffer = true;
+			}
+		}
+		//renew wasted array
+		localStorage.oldOffers = JSON.stringify(oldOffersArrayNew);
+		//renew knownArray
+		localStorage.knownOffers = JSON.stringify(knownOffersArrayNew);
+		
+		//show modal window, play sound
+		if (unknownOffer) {
+			$('#unknownOffers').modal('show');
+			document.getElementById('shekeli').play();
+		}
+	};
+	
+	//apply server diff: {new: [...], changed: [...], removed: [id, ...]}
+	var applyDiff = function(diff){
+		var offers = {};
+		var result = [];
+		diff.removed.forEach(function(id){ offers[id] = null; });
+		diff.changed.forEach(function(offer){ offers[offer.id] = offer; });
+		dupe.offers.forEach(function(offer){
+			if (offers[offer.id] === undefined) {
+				result.push(offer);
+			} else if (offers[offer.id] !== null) {
+				result.push(offers[offer.id]);
+			}
+		});
+		return result.concat(diff.new);
+	};
+	
 	var update = function(){
 		$('.progress .progress-bar').animate({
 			width: '100%'
 		}, settings.timeout * 1000, 'linear', function(){
 			$('.progress .progress-bar').css('width','0%');
 		});
-		$http.post(settings.url).success(function(data){
-			dupe.offers = data;
-			var oldOffersArray = JSON.parse(localStorage.oldOffers);
-			var oldOffersArrayNew = [];
-			var knownOffersArray = JSON.parse(localStorage.knownOffers);
-			var knownOffersArrayNew = [];
-			var id = "";
-			var unknownOffer = false;
-			for (var i = 0; i < dupe.offers.length; i++) {
-				id = dupe.offers[i].seller.date + '' + dupe.offers[i].buyer.date;
-				//is it old offer?
-				if (oldOffersArray.indexOf(id) != -1) {
-					//yeap, wasted
-					dupe.offers[i].old = true;
-					//show as wasted
-					oldOffersArrayNew.push(id);
-				} else {
-					//unchecked offer
-					dupe.offers[i].old = false;
-				}
-				//is it known offer?
-				if ((knownOffersArray.indexOf(id) != -1) || (dupe.offers[i].equity < $scope.minEquity && $scope.minEquityOn) || (dupe.offers[i].required_aden > $scope.maxRrequired && $scope.maxRrequiredOn) ) {
-					//yeap, nothing happens here
-					//keep in known array
-					knownOffersArrayNew.push(id);
-				} else {
-					//yay, new offers! flagged
-					unknownOffer = true;
-				}
-			}
-			//renew wasted array
-			localStorage.oldOffers = JSON.stringify(oldOffersArrayNew);
-			//renew knownArray
-			localStorage.knownOffers = JSON.stringify(knownOffersArrayNew);
-			
-			//show modal window, play sound
-			if (unknownOffer) {
-				$('#unknownOffers').modal('show');
-				document.getElementById('shekeli').play();
-			}
+		//server answers 304 without body when nothing changed since last poll
+		$http.post(settings.url, null, {headers: {'If-None-Match': etag}}).success(function(data, status, headers){
+			etag = headers('ETag');
+			showOffers(data);
+		});
+	}
+	
+	if (window.EventSource) {
+		//server pushes changes right after market update, no polling required
+		var stream = new EventSource(settings.streamUrl);
+		stream.addEventListener('snapshot', function(e){
+			$scope.$apply(function(){ showOffers(JSON.parse(e.data)); });
+		});
+		stream.addEventListener('diff', function(e){
+			$scope.$apply(function(){ showOffers(applyDiff(JSON.parse(e.data))); });
 		});
+	} else {
+		update();
+		setInterval(update, settings.timeout * 1000);
 	}
-	update();
-	setInterval(update, settings.timeout * 1000);
 }]);
 
 app.filter('trisect', function(){